@@ -5,13 +5,33 @@ from folium import IFrame
 from folium import plugins
 from streamlit_folium import folium_static
 import streamlit as st
+import streamlit.components.v1 as components
 from streamlit_js_eval import streamlit_js_eval
 from shapely.geometry import shape
 from streamlit_folium import st_folium
+from branca.element import MacroElement
+from jinja2 import Template
 import hashlib
 import colorsys
 import html
+import os
+import glob
+import gzip
+import shutil
+import json
+import time
+import zipfile
+import sys
+import uuid
+import contextlib
+import tracemalloc
+import threading
+import warnings
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 # NEW: interactive plotting
 import plotly.graph_objects as go
@@ -23,6 +43,13 @@ try:
 except Exception:
     PLOTLY_EVENTS_AVAILABLE = False
 
+try:
+    # optional: embedded SQL engine over locally cached observations
+    import duckdb
+    DUCKDB_AVAILABLE = True
+except Exception:
+    DUCKDB_AVAILABLE = False
+
 # ----------------------------
 # App setup
 # ----------------------------
@@ -83,45 +110,440 @@ def parse_reach_ids(text: str) -> list[str]:
             seen.add(t)
     return uniq
 
-def fetch_data(reach_id, start_time, end_time, fields):
-    base_url = "https://soto.podaac.earthdatacloud.nasa.gov/hydrocron/v1/timeseries"
+# ----------------------------
+# Field conventions + quality filtering
+# ----------------------------
+# SWOT fill values: float measurements / integer flags
+FILL_VALUE = -999999999999.0
+FILL_VALUES = [FILL_VALUE, -999]
+
+# Fields that are text; everything else is numeric (fill-masked after fetch,
+# stored typed in the cache so range predicates can be pushed down).
+TEXT_FIELDS = {
+    'reach_id', 'time_str', 'river_name', 'continent_id', 'range_start_time',
+    'range_end_time', 'crid', 'sword_version', 'collection_shortname',
+    'collection_version', 'granuleUR', 'ingest_time', 'rch_id_up', 'rch_id_dn'
+}
+
+# Declarative quality rules: field -> (operator, threshold).
+# SWOT summary flags: 0 good, 1 suspect, 2 degraded, 3 bad.
+QUALITY_RULES = {
+    'reach_q': ("<=", 1),
+    'dark_frac': ("<=", 0.5),
+    'ice_clim_f': ("<=", 1),
+    'partial_f': ("==", 0),
+    'xovr_cal_q': ("<=", 1),
+}
+QUALITY_OPERATORS = {
+    "<=": np.less_equal, "<": np.less, "==": np.equal, ">=": np.greater_equal, ">": np.greater
+}
+
+def mask_fill_values(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert numeric fields to numbers and replace SWOT fill values with NaN, column-wise."""
+    cols = [c for c in df.columns if c not in TEXT_FIELDS]
+    if not cols:
+        return df
+    df = df.copy()
+    num = df[cols].apply(pd.to_numeric, errors='coerce')
+    df[cols] = num.mask(num.isin(FILL_VALUES))
+    return df
+
+def quality_failures(df: pd.DataFrame, rules: dict) -> dict:
+    """
+    {field: boolean array of rows failing that rule}. Missing (NaN / fill) flag
+    values mean "not evaluated" and pass.
+    """
+    failures = {}
+    for field, (op, threshold) in rules.items():
+        if field in df.columns:
+            values = pd.to_numeric(df[field], errors='coerce').to_numpy(dtype='float64')
+            failures[field] = ~np.isnan(values) & ~QUALITY_OPERATORS[op](values, threshold)
+    return failures
+
+def quality_mask(df: pd.DataFrame, rules: dict) -> np.ndarray:
+    """Boolean array of rows passing every rule (missing flag values pass)."""
+    keep = np.ones(len(df), dtype=bool)
+    for failed in quality_failures(df, rules).values():
+        keep &= ~failed
+    return keep
+
+def quality_summary(dropped: int, dropped_by: dict) -> str:
+    """'Quality filters removed N observation(s) (rule: n, ...)' for captions."""
+    rules = ", ".join(
+        f"{field} {QUALITY_RULES[field][0]} {QUALITY_RULES[field][1]}: {n:,}"
+        for field, n in dropped_by.items() if n and field in QUALITY_RULES
+    )
+    return f"Quality filters removed {dropped:,} observation(s)" + (f" ({rules})." if rules else ".")
+
+# ----------------------------
+# Hydrocron requests (live / record / replay)
+# ----------------------------
+HYDROCRON_URL = os.environ.get(
+    "HYDROCRON_URL", "https://soto.podaac.earthdatacloud.nasa.gov/hydrocron/v1/timeseries"
+)
+# Seconds to wait for a connection / for the response, so a hung request cannot hold a slot forever
+HYDROCRON_TIMEOUT = float(os.environ.get("HYDROCRON_TIMEOUT", "60"))
+# Local state (observation cache, cassettes, ...) lives here
+CACHE_DIR = os.environ.get(
+    "HYDROCRON_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".hydrocron_cache")
+)
+# "live" (default), "record" (live + write cassettes) or "replay" (serve cassettes, no network)
+NETWORK_MODES = ["live", "record", "replay"]
+HYDROCRON_MODE = os.environ.get("HYDROCRON_MODE", "live")
+if HYDROCRON_MODE not in NETWORK_MODES:
+    warnings.warn(f"Unknown HYDROCRON_MODE {HYDROCRON_MODE!r}; falling back to 'live'.")
+    HYDROCRON_MODE = "live"
+
+def cassette_path(params: dict) -> str:
+    """Cassette file for a request, keyed by its fetch_data parameters."""
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:32]
+    return os.path.join(CACHE_DIR, "cassettes", f"{key}.json.gz")
+
+def record_cassette(params: dict, response, elapsed: float) -> str:
+    """Write a gzip-compressed request/response cassette, including the observed latency."""
+    path = cassette_path(params)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cassette = {
+        "request": {"url": HYDROCRON_URL, "params": params},
+        "status": response.status_code,
+        "elapsed": elapsed,
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "body": response.text,
+    }
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as fh:
+        json.dump(cassette, fh)
+    os.replace(tmp_path, path)
+    return path
+
+def replay_cassette(params: dict, latency: bool = True) -> dict:
+    """Serve a recorded response, sleeping for its original latency unless latency=False."""
+    path = cassette_path(params)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No recorded response for this request (expected {os.path.basename(path)}).")
+    with gzip.open(path, "rt", encoding="utf-8") as fh:
+        cassette = json.load(fh)
+    if latency:
+        time.sleep(cassette.get("elapsed", 0))
+    return json.loads(cassette["body"])
+
+class JobCancelled(RuntimeError):
+    """Raised inside a fetch when its background job was cancelled."""
+
+class HydrocronThrottled(RuntimeError):
+    """Hydrocron answered 429 or 5xx; retry_after is in seconds when the server sent one."""
+    def __init__(self, status: int, retry_after: float | None = None):
+        super().__init__(f"Hydrocron returned HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+def hydrocron_get(params: dict, mode: str | None = None) -> dict:
+    """GET the Hydrocron timeseries endpoint honouring the record/replay mode."""
+    mode = mode or HYDROCRON_MODE
+    if mode == "replay":
+        return replay_cassette(params)
+    started = time.perf_counter()
+    response = requests.get(HYDROCRON_URL, params=params, timeout=(10, HYDROCRON_TIMEOUT))
+    elapsed = time.perf_counter() - started
+    if response.status_code == 429 or response.status_code >= 500:
+        retry_after = response.headers.get("Retry-After")
+        raise HydrocronThrottled(
+            response.status_code,
+            float(retry_after) if retry_after and retry_after.replace(".", "", 1).isdigit() else None
+        )
+    if mode == "record":
+        record_cassette(params, response, elapsed)
+    return response.json()
+
+# ----------------------------
+# Client-side rate limiting + adaptive concurrency
+# ----------------------------
+HYDROCRON_MAX_RPS = float(os.environ.get("HYDROCRON_MAX_RPS", "10"))
+HYDROCRON_MAX_INFLIGHT = int(os.environ.get("HYDROCRON_MAX_INFLIGHT", "16"))
+MAX_ATTEMPTS = 4
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` requests per second with bursts up to `capacity`."""
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AIMDController:
+    """
+    Adaptive in-flight limit (AIMD). Each healthy response adds 1/limit (about +1
+    per round of requests); a 429/5xx or a latency spike halves the limit. Signals
+    from requests started before the last cut are ignored so one burst of
+    throttling only cuts once.
+    """
+    def __init__(self, initial: int = 2, minimum: int = 1, maximum: int = HYDROCRON_MAX_INFLIGHT,
+                 spike_factor: float = 3.0, alpha: float = 0.2):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.spike_factor = spike_factor
+        self.alpha = alpha
+        self.baseline = None        # EWMA latency of healthy responses
+        self.in_flight = 0
+        self.last_cut = 0.0
+        self.history = []           # (monotonic time, limit) after every change
+        self.cond = threading.Condition()
+
+    def acquire(self) -> float:
+        """Block until a slot is free; returns the request start time to pass to release()."""
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started: float, latency: float, throttled: bool = False):
+        with self.cond:
+            self.in_flight -= 1
+            spike = (
+                not throttled and self.baseline is not None
+                and latency > self.spike_factor * self.baseline
+            )
+            if throttled or spike:
+                if started >= self.last_cut:
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self.last_cut = time.monotonic()
+            else:
+                self.baseline = latency if self.baseline is None else (
+                    (1 - self.alpha) * self.baseline + self.alpha * latency
+                )
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.history.append((time.monotonic(), self.limit))
+            del self.history[:-1000]
+            self.cond.notify_all()
+
+    def discard(self):
+        """Free a slot without a signal: the request failed for a reason unrelated to load."""
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+@st.cache_resource
+def hydrocron_limiter():
+    """Token bucket + AIMD controller shared by every session in this process."""
+    return TokenBucket(HYDROCRON_MAX_RPS), AIMDController()
+
+# Failures that mean the backend is overloaded or unreachable: cut the limit and retry
+CONGESTION_ERRORS = (HydrocronThrottled, requests.Timeout, requests.ConnectionError)
+
+def limited_get(params: dict, mode: str | None = None, limiter=None) -> dict:
+    """
+    hydrocron_get under the shared rate limit and adaptive concurrency, retrying
+    throttled, timed-out and refused calls. Only successful responses count as
+    healthy; other failures free their slot without moving the limit.
+    """
+    if (mode or HYDROCRON_MODE) == "replay":
+        return hydrocron_get(params, mode)
+    bucket, controller = limiter or hydrocron_limiter()
+    for attempt in range(MAX_ATTEMPTS):
+        bucket.acquire()
+        started = controller.acquire()
+        t0 = time.perf_counter()
+        try:
+            result = hydrocron_get(params, mode)
+        except CONGESTION_ERRORS as e:
+            controller.release(started, time.perf_counter() - t0, throttled=True)
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            retry_after = getattr(e, "retry_after", None)
+            time.sleep(retry_after if retry_after is not None else 0.5 * 2 ** attempt)
+            continue
+        except BaseException:
+            controller.discard()
+            raise
+        controller.release(started, time.perf_counter() - t0)
+        return result
+
+# ----------------------------
+# Reach metadata sidecar (static SWORD attributes)
+# ----------------------------
+# Per-reach attributes that do not change between observations. They are
+# fetched once per reach, kept in REACH_META_DIR and joined locally, so
+# time-series requests only carry the dynamic fields.
+STATIC_FIELDS = {
+    'river_name', 'continent_id', 'rch_id_up', 'rch_id_dn', 'n_reach_up', 'n_reach_dn',
+    'sword_version', 'p_lat', 'p_lon', 'p_wse', 'p_wse_var', 'p_width', 'p_wid_var',
+    'p_n_nodes', 'p_dist_out', 'p_length', 'p_maf', 'p_dam_id', 'p_n_ch_max', 'p_n_ch_mod',
+    'p_low_slp',
+}
+REACH_META_DIR = os.path.join(CACHE_DIR, "reach_meta")
+REACH_META_MAX_AGE_DAYS = float(os.environ.get("HYDROCRON_META_MAX_AGE_DAYS", "30"))
+
+@st.cache_resource
+def _reach_metadata_store():
+    """In-process copy of the sidecar: (dict reach_id -> metadata, lock)."""
+    return {}, threading.Lock()
+
+def load_reach_metadata(reach_id) -> dict:
+    """Stored static fields for a reach ({} when unknown or older than REACH_META_MAX_AGE_DAYS)."""
+    rid = str(reach_id)
+    store, lock = _reach_metadata_store()
+    with lock:
+        meta = store.get(rid)
+    if meta is None:
+        path = os.path.join(REACH_META_DIR, f"{rid}.json")
+        if not rid.isalnum() or not os.path.exists(path):
+            return {}
+        with open(path) as fh:
+            meta = json.load(fh)
+        with lock:
+            store[rid] = meta
+    if meta.get("fetched_at", 0) < time.time() - REACH_META_MAX_AGE_DAYS * 86400:
+        return {}
+    return meta.get("fields", {})
+
+def save_reach_metadata(reach_id, df: pd.DataFrame, fields: list[str]):
+    """Record the first valid value of each static field (None when the reach has none)."""
+    rid = str(reach_id)
+    if not rid.isalnum() or df.empty:
+        return
+    values = {}
+    for f in fields:
+        col = df[f].dropna()
+        value = col.iloc[0] if len(col) else None
+        values[f] = value.item() if isinstance(value, np.generic) else value
+    store, lock = _reach_metadata_store()
+    with lock:
+        meta = store.get(rid) or {"fields": {}}
+        meta = {"fields": {**meta["fields"], **values}, "fetched_at": time.time()}
+        store[rid] = meta
+        os.makedirs(REACH_META_DIR, exist_ok=True)
+        tmp_path = os.path.join(REACH_META_DIR, f"{rid}.json.tmp")
+        with open(tmp_path, "w") as fh:
+            json.dump(meta, fh)
+        os.replace(tmp_path, os.path.join(REACH_META_DIR, f"{rid}.json"))
+
+def fetch_data(reach_id, start_time, end_time, fields, quality_rules=None, network_mode=None, limiter=None):
+    field_list = fields.split(',')
+    # Static fields come from the sidecar once a reach is known; only the
+    # first request for a reach carries them. Record/replay always request the
+    # caller's fields so cassette keys do not depend on local sidecar state.
+    static = [f for f in field_list if f in STATIC_FIELDS]
+    live = (network_mode or HYDROCRON_MODE) == "live"
+    meta = load_reach_metadata(reach_id) if static and live else {}
+    if any(f not in meta for f in static):
+        meta, request_fields = None, field_list
+    else:
+        request_fields = [f for f in field_list if f not in STATIC_FIELDS] or ['reach_id']
     params = {
         "feature": "Reach",
         "feature_id": reach_id,
         "start_time": start_time,
         "end_time": end_time,
         "output": "geojson",
-        "fields": fields
+        "fields": ','.join(request_fields)
     }
-    hydrocron_response = requests.get(base_url, params=params).json()
+    hydrocron_response = limited_get(params, network_mode, limiter)
     # Extract geojson and table
     geojson_data = hydrocron_response['results']['geojson']
     data_list = []
     for feature in geojson_data['features']:
         properties = feature['properties']
-        data_list.append([properties.get(field, None) for field in fields.split(',')])
-    df = pd.DataFrame(data_list, columns=fields.split(','))
-    if 'time_str' in df.columns:
-        df = df[df['time_str'] != 'no_data']
+        data_list.append([properties.get(field, None) for field in request_fields])
+    df = mask_fill_values(pd.DataFrame(data_list, columns=request_fields))
+    if meta is None:
+        save_reach_metadata(reach_id, df, static)
+    elif static:
+        joined = {f: meta[f] for f in static}
+        for feature in geojson_data['features']:
+            feature['properties'].update(joined)
+        df = df.assign(**{
+            f: np.nan if v is None and f not in TEXT_FIELDS else v for f, v in joined.items()
+        }).reindex(columns=field_list)
+
+    # Quality stage: drop failing observations from both the table and the
+    # features so the map/plot/export never see them. 'no_data' placeholders
+    # keep their geometry on the map but never reach the table.
+    no_data = (df['time_str'] == 'no_data').to_numpy() if 'time_str' in df.columns else np.zeros(len(df), dtype=bool)
+    failures = quality_failures(df, quality_rules) if quality_rules else {}
+    passed = quality_mask(df, quality_rules) if quality_rules else np.ones(len(df), dtype=bool)
+    if not passed.all():
+        geojson_data['features'] = [
+            f for f, keep in zip(geojson_data['features'], passed | no_data) if keep
+        ]
+    df = df[passed & ~no_data].copy()
+    df.attrs['quality_dropped'] = int((~passed & ~no_data).sum())
+    df.attrs['quality_dropped_by'] = {field: int((failed & ~no_data).sum()) for field, failed in failures.items()}
     df['ID'] = range(1, len(df) + 1)
     return geojson_data, df, start_time, end_time
 
-def fetch_data_multi(reach_ids: list[str], start_time, end_time, fields):
-    """Fetch and combine multiple reach ids. Returns (FeatureCollection, combined_df, errors)."""
+def fetch_data_multi(reach_ids: list[str], start_time, end_time, fields, quality_rules=None,
+                     network_mode=None, limiter=None, progress=None, cancel=None,
+                     thread_name_prefix: str = "hydrocron-fetch"):
+    """
+    Fetch and combine multiple reach ids. Returns (FeatureCollection, combined_df, errors).
+    Reaches are fetched concurrently; the shared limiter decides how many are in flight.
+    Fields needed by quality_rules are requested even when not selected, then dropped.
+    progress(done, total) is called as reaches complete; setting the `cancel`
+    threading.Event stops remaining reaches and raises JobCancelled.
+    Worker threads are named `thread_name_prefix`_N (the profiler samples by name).
+    """
     all_features = []
     df_list = []
     errors = []
+    dropped = 0
+    dropped_by = Counter()
 
-    for rid in reach_ids:
-        try:
-            gjson, df, _, _ = fetch_data(rid, start_time, end_time, fields)
-            feats = gjson.get('features', [])
-            if feats:
-                all_features.extend(feats)
-            if not df.empty:
-                df_list.append(df)
-        except Exception as e:
-            errors.append(f"{rid}: {e}")
+    requested = fields.split(',')
+    rule_fields = [f for f in (quality_rules or {}) if f not in requested]
+    fetch_fields = ','.join(requested + rule_fields)
+
+    def fetch_one(rid):
+        if cancel is not None and cancel.is_set():
+            raise JobCancelled("cancelled")
+        return fetch_data(rid, start_time, end_time, fetch_fields, quality_rules, network_mode, limiter)
+
+    completed = {"n": 0}
+    completed_lock = threading.Lock()
+
+    def on_done(_future):
+        with completed_lock:
+            completed["n"] += 1
+            n = completed["n"]
+        if progress is not None:
+            progress(n, len(reach_ids))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(reach_ids), HYDROCRON_MAX_INFLIGHT)),
+                            thread_name_prefix=thread_name_prefix) as pool:
+        futures = [(rid, pool.submit(fetch_one, rid)) for rid in reach_ids]
+        for _, future in futures:
+            future.add_done_callback(on_done)
+        # collect in input order so the table and map stay deterministic
+        for rid, future in futures:
+            try:
+                gjson, df, _, _ = future.result()
+                dropped += df.attrs.get('quality_dropped', 0)
+                dropped_by.update(df.attrs.get('quality_dropped_by', {}))
+                feats = gjson.get('features', [])
+                if feats:
+                    all_features.extend(feats)
+                if not df.empty:
+                    df_list.append(df.drop(columns=rule_fields))
+            except Exception as e:
+                errors.append(f"{rid}: {e}")
+
+    if cancel is not None and cancel.is_set():
+        raise JobCancelled("Job was cancelled.")
 
     combined_geojson = {"type": "FeatureCollection", "features": all_features}
 
@@ -129,10 +551,818 @@ def fetch_data_multi(reach_ids: list[str], start_time, end_time, fields):
         combined_df = pd.concat(df_list, ignore_index=True)
         combined_df['ID'] = range(1, len(combined_df) + 1)
     else:
-        combined_df = pd.DataFrame(columns=fields.split(',') + ['ID'])
+        combined_df = pd.DataFrame(columns=requested + ['ID'])
+    combined_df.attrs['quality_dropped'] = dropped
+    combined_df.attrs['quality_dropped_by'] = dict(dropped_by)
 
     return combined_geojson, combined_df, errors
 
+# ----------------------------
+# Node-level time series (compact columnar storage)
+# ----------------------------
+NODE_FIELDS = ['node_id', 'time_str', 'cycle_id', 'pass_id', 'p_dist_out', 'node_q', 'wse', 'width']
+NODE_VALUE_FIELDS = ['wse', 'width']
+
+@dataclass
+class NodeTimeSeries:
+    """
+    All node observations of one reach on a shared overpass index.
+    Nodes are ordered upstream -> downstream (descending p_dist_out);
+    values[field] is float32 (n_overpasses, n_nodes) with NaN where a node was not observed.
+    """
+    reach_id: str
+    node_ids: np.ndarray      # int64 (n_nodes,)
+    p_dist_out: np.ndarray    # float32 (n_nodes,), metres from outlet
+    times: np.ndarray         # datetime64[s] (n_overpasses,), earliest node time per overpass
+    cycle_pass: np.ndarray    # int32 (n_overpasses, 2)
+    values: dict
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.node_ids, self.p_dist_out, self.times, self.cycle_pass, *self.values.values()]
+        return sum(a.nbytes for a in arrays)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Long format (one row per observed node per overpass) for export."""
+        n_over, n_nodes = len(self.times), len(self.node_ids)
+        out = pd.DataFrame({
+            'reach_id': self.reach_id,
+            'node_id': np.tile(self.node_ids, n_over),
+            'p_dist_out': np.tile(self.p_dist_out, n_over),
+            'time': np.repeat(self.times, n_nodes),
+            'cycle_id': np.repeat(self.cycle_pass[:, 0], n_nodes),
+            'pass_id': np.repeat(self.cycle_pass[:, 1], n_nodes),
+        })
+        for field, matrix in self.values.items():
+            out[field] = matrix.ravel()
+        return out.dropna(subset=list(self.values), how='all').reset_index(drop=True)
+
+def node_ids_for_reach(reach_id: str, n_nodes: int) -> list[str]:
+    """SWORD node ids of a reach: CBBBBBRRRR + node number (001..) + type digit."""
+    rid = str(reach_id)
+    return [f"{rid[:10]}{k:03d}{rid[-1]}" for k in range(1, n_nodes + 1)]
+
+def resolve_reach_nodes(reach_id, start_time, end_time, network_mode=None, limiter=None) -> list[str]:
+    """Look up p_n_nodes for a reach (sidecar first in live mode) and return its node ids."""
+    live = (network_mode or HYDROCRON_MODE) == "live"
+    n_nodes = load_reach_metadata(reach_id).get('p_n_nodes') if live else None
+    if n_nodes:
+        return node_ids_for_reach(reach_id, int(n_nodes))
+    response = limited_get({
+        "feature": "Reach", "feature_id": reach_id, "start_time": start_time, "end_time": end_time,
+        "output": "geojson", "fields": "reach_id,time_str,p_n_nodes"
+    }, network_mode, limiter)
+    for feature in response['results']['geojson']['features']:
+        n_nodes = pd.to_numeric(feature['properties'].get('p_n_nodes'), errors='coerce')
+        if pd.notna(n_nodes) and n_nodes > 0:
+            save_reach_metadata(reach_id, pd.DataFrame({'p_n_nodes': [float(n_nodes)]}), ['p_n_nodes'])
+            return node_ids_for_reach(reach_id, int(n_nodes))
+    raise ValueError(f"Could not resolve nodes for reach {reach_id} (no p_n_nodes).")
+
+def fetch_node_rows(node_id, start_time, end_time, network_mode=None, limiter=None) -> list[list]:
+    """Raw NODE_FIELDS rows of one node (no DataFrame; rows are packed per reach)."""
+    response = limited_get({
+        "feature": "Node", "feature_id": node_id, "start_time": start_time, "end_time": end_time,
+        "output": "geojson", "fields": ",".join(NODE_FIELDS)
+    }, network_mode, limiter)
+    rows = []
+    for feature in response['results']['geojson']['features']:
+        props = feature['properties']
+        if props.get('time_str') != 'no_data':
+            rows.append([props.get(field) for field in NODE_FIELDS])
+    return rows
+
+def pack_node_rows(reach_id: str, rows: list, max_node_q: int | None = 1) -> NodeTimeSeries | None:
+    """Pack raw node rows into a NodeTimeSeries aligned on (cycle_id, pass_id)."""
+    if not rows:
+        return None
+    columns = list(zip(*rows))
+    col = {field: columns[i] for i, field in enumerate(NODE_FIELDS)}
+
+    def numeric(field):
+        values = pd.to_numeric(pd.Series(col[field], dtype=object), errors='coerce').to_numpy('float64')
+        values[np.isin(values, FILL_VALUES)] = np.nan
+        return values
+
+    node_id = numeric('node_id')
+    cycle, pass_ = numeric('cycle_id'), numeric('pass_id')
+    valid = ~(np.isnan(node_id) | np.isnan(cycle) | np.isnan(pass_))
+    if max_node_q is not None:
+        valid &= numeric('node_q') <= max_node_q
+    if not valid.any():
+        return None
+
+    node_id = node_id[valid].astype('int64')
+    overpass = (cycle[valid] * 1000 + pass_[valid]).astype('int64')
+    times = pd.to_datetime(pd.Series(col['time_str'], dtype=object)[valid],
+                           errors='coerce', utc=True, format='ISO8601')
+    times = times.dt.tz_localize(None).to_numpy('datetime64[s]')
+
+    keys, over_idx = np.unique(overpass, return_inverse=True)
+    nodes, node_idx = np.unique(node_id, return_inverse=True)
+
+    first_time = np.full(len(keys), np.iinfo('int64').max, dtype='int64')
+    np.minimum.at(first_time, over_idx, times.view('int64'))
+    first_time = first_time.view('datetime64[s]')
+
+    dist = np.full(len(nodes), np.nan, dtype='float32')
+    dist[node_idx] = numeric('p_dist_out')[valid]
+
+    values = {}
+    for field in NODE_VALUE_FIELDS:
+        matrix = np.full((len(keys), len(nodes)), np.nan, dtype='float32')
+        matrix[over_idx, node_idx] = numeric(field)[valid]
+        values[field] = matrix
+
+    node_order = np.argsort(np.where(np.isnan(dist), -np.inf, -dist), kind='stable')
+    time_order = np.argsort(first_time, kind='stable')
+    return NodeTimeSeries(
+        reach_id=str(reach_id),
+        node_ids=nodes[node_order],
+        p_dist_out=dist[node_order],
+        times=first_time[time_order],
+        cycle_pass=np.stack([keys // 1000, keys % 1000], axis=1)[time_order].astype('int32'),
+        values={f: m[np.ix_(time_order, node_order)] for f, m in values.items()},
+    )
+
+def fetch_node_series(reach_ids: list[str], start_time, end_time, network_mode=None, limiter=None,
+                      max_node_q: int | None = 1, thread_name_prefix: str = "hydrocron-nodes"):
+    """
+    Node mode: resolve every reach to its nodes concurrently, then fetch the nodes of
+    all reaches through one pool; the shared limiter paces the requests.
+    Returns ({reach_id: NodeTimeSeries}, errors).
+    """
+    series, errors = {}, []
+    with ThreadPoolExecutor(max_workers=HYDROCRON_MAX_INFLIGHT, thread_name_prefix=thread_name_prefix) as pool:
+        resolving = [
+            (rid, pool.submit(resolve_reach_nodes, rid, start_time, end_time, network_mode, limiter))
+            for rid in reach_ids
+        ]
+        fetching = []
+        for rid, future in resolving:
+            try:
+                node_ids = future.result()
+            except Exception as e:
+                errors.append(f"{rid}: {e}")
+                continue
+            fetching.append((rid, [
+                (nid, pool.submit(fetch_node_rows, nid, start_time, end_time, network_mode, limiter))
+                for nid in node_ids
+            ]))
+        for rid, futures in fetching:
+            rows = []
+            for nid, future in futures:
+                try:
+                    rows.extend(future.result())
+                except Exception as e:
+                    errors.append(f"{nid}: {e}")
+            packed = pack_node_rows(rid, rows, max_node_q)
+            if packed is not None:
+                series[rid] = packed
+    return series, errors
+
+def node_profile_figure(series: dict, field: str = 'wse'):
+    """
+    Along-reach profiles: one trace per reach, each overpass drawn as its own
+    segment (NaN breaks) over distance from outlet, so hundreds of overpasses stay one trace.
+    """
+    fig = go.Figure()
+    for rid, s in series.items():
+        matrix = s.values[field]
+        n_over, n_nodes = matrix.shape
+        x = np.hstack([np.tile(s.p_dist_out / 1000.0, (n_over, 1)), np.full((n_over, 1), np.nan)]).ravel()
+        y = np.hstack([matrix, np.full((n_over, 1), np.nan)]).ravel()
+        when = np.repeat(pd.to_datetime(s.times).strftime('%Y-%m-%d %H:%M').to_numpy(), n_nodes + 1)
+        color = nice_color_for_reach(rid)
+        fig.add_trace(go.Scatter(
+            x=x, y=y, mode='lines+markers', name=rid, connectgaps=False,
+            line=dict(width=1.5, color=color), marker=dict(size=4, color=color),
+            customdata=when,
+            hovertemplate="<b>Reach:</b> " + rid + "<br><b>Overpass:</b> %{customdata}<br>"
+                          "<b>Dist. from outlet (km):</b> %{x:.2f}<br>"
+                          "<b>" + field.upper() + ":</b> %{y:.3f}<extra></extra>"
+        ))
+    fig.update_layout(
+        template="plotly_dark",
+        height=420,
+        margin=dict(l=40, r=20, t=50, b=40),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0),
+        xaxis=dict(title="Distance from outlet (km)", autorange="reversed", showgrid=True, gridwidth=0.3),
+        yaxis=dict(title="Water Surface Elevation (m)" if field == 'wse' else field, showgrid=True, gridwidth=0.3),
+    )
+    return fig
+
+# ----------------------------
+# Background jobs (survive reruns, refreshes and closed tabs)
+# ----------------------------
+JOBS_DIR = os.path.join(CACHE_DIR, "jobs")
+JOB_WORKERS = int(os.environ.get("HYDROCRON_JOB_WORKERS", "2"))
+JOB_QUEUE_LIMIT = int(os.environ.get("HYDROCRON_JOB_QUEUE", "8"))
+JOB_ACTIVE = ("queued", "running")
+JOB_RETENTION_DAYS = float(os.environ.get("HYDROCRON_JOB_RETENTION_DAYS", "7"))
+
+class JobManager:
+    """
+    Bounded background worker pool for long multi-reach downloads.
+    Job state (meta.json) and results (table.parquet + features.json.gz) persist
+    under JOBS_DIR/<job_id>/, so a result can be collected from any later session.
+    Jobs untouched for JOB_RETENTION_DAYS are removed on startup and on each submit.
+    """
+    def __init__(self, workers: int = JOB_WORKERS, queue_limit: int = JOB_QUEUE_LIMIT):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hydrocron-job")
+        self.queue_limit = queue_limit
+        self.jobs = {}
+        self.cancel_events = {}
+        self.lock = threading.Lock()
+        self.prune()
+
+    def prune(self, max_age_days: float = JOB_RETENTION_DAYS):
+        """Remove finished job directories whose meta.json was last written more than max_age_days ago."""
+        cutoff = time.time() - max_age_days * 86400
+        for path in glob.glob(os.path.join(JOBS_DIR, "*", "meta.json")):
+            job_id = os.path.basename(os.path.dirname(path))
+            with self.lock:
+                if self.jobs.get(job_id, {}).get("status") in JOB_ACTIVE:
+                    continue
+                try:
+                    if os.path.getmtime(path) >= cutoff:
+                        continue
+                except OSError:
+                    continue
+                self.jobs.pop(job_id, None)
+                self.cancel_events.pop(job_id, None)
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def _write_meta(self, meta: dict):
+        job_dir = os.path.join(JOBS_DIR, meta["id"])
+        os.makedirs(job_dir, exist_ok=True)
+        tmp_path = os.path.join(job_dir, "meta.json.tmp")
+        with open(tmp_path, "w") as fh:
+            json.dump(meta, fh)
+        os.replace(tmp_path, os.path.join(job_dir, "meta.json"))
+
+    def submit(self, reach_ids, start_time, end_time, fields, quality_rules=None, network_mode=None) -> str:
+        self.prune()
+        with self.lock:
+            active = sum(1 for job in self.jobs.values() if job["status"] in JOB_ACTIVE)
+            if active >= self.queue_limit:
+                raise RuntimeError(f"The job queue is full ({active} active jobs). Try again later.")
+            job_id = uuid.uuid4().hex[:12]
+            meta = {
+                "id": job_id, "status": "queued", "reach_ids": list(reach_ids),
+                "start_time": start_time, "end_time": end_time, "fields": fields,
+                "quality_rules": quality_rules or {}, "network_mode": network_mode,
+                "submitted_at": time.time(), "started_at": None, "finished_at": None,
+                "done": 0, "total": len(reach_ids), "rows": None, "errors": [], "error": None,
+            }
+            self.jobs[job_id] = meta
+            self.cancel_events[job_id] = threading.Event()
+            self._write_meta(meta)
+        self.pool.submit(self._run, job_id)
+        return job_id
+
+    def _update(self, job_id: str, **changes):
+        with self.lock:
+            meta = self.jobs[job_id]
+            meta.update(changes)
+            self._write_meta(meta)
+
+    def _run(self, job_id: str):
+        meta, cancel = self.jobs[job_id], self.cancel_events[job_id]
+        if cancel.is_set():
+            self._update(job_id, status="cancelled", finished_at=time.time())
+            return
+        self._update(job_id, status="running", started_at=time.time())
+        try:
+            geojson_data, df, errors = fetch_data_multi(
+                meta["reach_ids"], meta["start_time"], meta["end_time"], meta["fields"],
+                {k: tuple(v) for k, v in meta["quality_rules"].items()}, meta["network_mode"],
+                progress=lambda done, total: self._update(job_id, done=done),
+                cancel=cancel,
+            )
+            job_dir = os.path.join(JOBS_DIR, job_id)
+            df.to_parquet(os.path.join(job_dir, "table.parquet"), index=False)
+            with gzip.open(os.path.join(job_dir, "features.json.gz"), "wt", encoding="utf-8") as fh:
+                json.dump(geojson_data, fh)
+            try:
+                cache_observations(df)
+            except Exception as e:
+                errors.append(f"cache: {e}")
+            self._update(job_id, status="done", finished_at=time.time(), rows=len(df), errors=errors)
+        except JobCancelled:
+            self._update(job_id, status="cancelled", finished_at=time.time())
+        except Exception as e:
+            self._update(job_id, status="failed", finished_at=time.time(), error=str(e))
+
+    def cancel(self, job_id: str):
+        if job_id in self.cancel_events:
+            self.cancel_events[job_id].set()
+
+    def get(self, job_id: str) -> dict | None:
+        """Job meta from memory, else from disk (a job left active by a dead process reads 'interrupted')."""
+        with self.lock:
+            if job_id in self.jobs:
+                return dict(self.jobs[job_id])
+        path = os.path.join(JOBS_DIR, str(job_id), "meta.json")
+        if not str(job_id).isalnum() or not os.path.exists(path):
+            return None
+        with open(path) as fh:
+            meta = json.load(fh)
+        if meta["status"] in JOB_ACTIVE:
+            meta["status"] = "interrupted"
+        return meta
+
+    def list_jobs(self, job_ids, limit: int = 20) -> list[dict]:
+        """Meta of the given jobs (unknown or pruned ids are skipped), newest first."""
+        metas = [m for m in (self.get(i) for i in dict.fromkeys(job_ids)) if m]
+        return sorted(metas, key=lambda m: m["submitted_at"], reverse=True)[:limit]
+
+    def load_result(self, job_id: str):
+        """(FeatureCollection, DataFrame, errors) of a finished job."""
+        meta = self.get(job_id)
+        if not meta or meta["status"] != "done":
+            raise ValueError(f"Job {job_id} has no result yet.")
+        job_dir = os.path.join(JOBS_DIR, job_id)
+        with gzip.open(os.path.join(job_dir, "features.json.gz"), "rt", encoding="utf-8") as fh:
+            geojson_data = json.load(fh)
+        return geojson_data, pd.read_parquet(os.path.join(job_dir, "table.parquet")), meta["errors"]
+
+def job_eta(meta: dict) -> float | None:
+    """Seconds remaining for a running job, extrapolated from completed reaches."""
+    if meta["status"] != "running" or not meta["done"] or not meta["started_at"]:
+        return None
+    elapsed = time.time() - meta["started_at"]
+    return elapsed / meta["done"] * (meta["total"] - meta["done"])
+
+@st.cache_resource
+def job_manager() -> JobManager:
+    """One job manager per process, shared by every session."""
+    return JobManager()
+
+# ----------------------------
+# Watchlist: scheduled delta prefetch into the local cache
+# ----------------------------
+WATCHLIST_PATH = os.path.join(CACHE_DIR, "watchlist.json")
+GEOM_DIR = os.path.join(CACHE_DIR, "geom")
+WATCHLIST_FIELDS = [
+    'reach_id', 'time_str', 'river_name', 'continent_id', 'wse', 'wse_u', 'width', 'width_u',
+    'slope', 'cycle_id', 'pass_id', 'range_end_time', 'ingest_time', *QUALITY_RULES
+]
+
+@st.cache_resource
+def _watchlist_lock():
+    return threading.Lock()
+
+def load_watchlist() -> dict:
+    """Watchlist config and per-reach refresh state ({} fields filled with defaults)."""
+    watchlist = {
+        "reach_ids": [], "interval_hours": 24.0, "history_start": "2022-07-01T00:00:00Z",
+        "fields": WATCHLIST_FIELDS, "auto_refresh": False, "state": {},
+    }
+    if os.path.exists(WATCHLIST_PATH):
+        with open(WATCHLIST_PATH) as fh:
+            watchlist.update(json.load(fh))
+    return watchlist
+
+def save_watchlist(watchlist: dict):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with _watchlist_lock():
+        tmp_path = WATCHLIST_PATH + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(watchlist, fh, indent=1)
+        os.replace(tmp_path, WATCHLIST_PATH)
+
+def save_reach_geometry(geojson_data):
+    """Keep one geometry per reach so cached observations can still be drawn on the map."""
+    os.makedirs(GEOM_DIR, exist_ok=True)
+    seen = set()
+    for feature in geojson_data.get('features', []):
+        rid = str(feature.get('properties', {}).get('reach_id', ''))
+        if rid.isalnum() and rid not in seen and feature.get('geometry'):
+            seen.add(rid)
+            with open(os.path.join(GEOM_DIR, f"{rid}.json"), "w") as fh:
+                json.dump(feature['geometry'], fh)
+
+def load_reach_geometry(reach_id: str):
+    path = os.path.join(GEOM_DIR, f"{reach_id}.json")
+    if not str(reach_id).isalnum() or not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        return json.load(fh)
+
+def refresh_watchlist(watchlist: dict | None = None, network_mode=None) -> list[str]:
+    """
+    Delta refresh: each reach is fetched only from its watermark (latest
+    range_end_time / time_str already cached) to now, then merged into the cache.
+    Returns the errors.
+    """
+    watchlist = watchlist or load_watchlist()
+    fields = ','.join(watchlist["fields"])
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    errors = []
+
+    def refresh_one(rid):
+        since = watchlist["state"].get(rid, {}).get("watermark") or watchlist["history_start"]
+        return fetch_data(rid, since, now, fields, None, network_mode)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(watchlist["reach_ids"]), HYDROCRON_MAX_INFLIGHT))) as pool:
+        futures = [(rid, pool.submit(refresh_one, rid)) for rid in watchlist["reach_ids"]]
+        for rid, future in futures:
+            try:
+                geojson_data, df, _, _ = future.result()
+                cache_observations(df)
+                if load_reach_geometry(rid) is None:
+                    save_reach_geometry(geojson_data)
+                state = watchlist["state"].setdefault(rid, {})
+                marks = [state.get("watermark")]
+                for col in ('range_end_time', 'time_str'):
+                    if col in df.columns and df[col].notna().any():
+                        marks.append(str(df[col].dropna().max()))
+                        break
+                state["watermark"] = max([m for m in marks if m], default=None)
+                state["refreshed_at"] = time.time()
+                state["new_rows"] = len(df)
+            except Exception as e:
+                errors.append(f"{rid}: {e}")
+
+    latest = load_watchlist()
+    latest["state"].update({rid: st_ for rid, st_ in watchlist["state"].items() if rid in latest["reach_ids"]})
+    latest["last_run"] = time.time()
+    latest["last_errors"] = errors
+    save_watchlist(latest)
+    return errors
+
+def watchlist_covers(watchlist: dict, reach_id: str, start_time: str, fields: list[str]) -> bool:
+    """True when a watchlist reach's cache is fresh, starts early enough and holds every field."""
+    state = watchlist["state"].get(reach_id, {})
+    fresh_for = watchlist["interval_hours"] * 3600 * 1.5
+    return (
+        reach_id in watchlist["reach_ids"]
+        and state.get("refreshed_at", 0) > time.time() - fresh_for
+        and (not start_time or watchlist["history_start"] <= start_time)
+        and set(fields) <= set(watchlist["fields"])
+        and load_reach_geometry(reach_id) is not None
+    )
+
+def serve_from_watchlist(reach_ids, start_time, end_time, fields: list[str], quality_rules=None):
+    """
+    Answer watchlist reaches from the local cache (no network).
+    Returns (features, df, remaining_reach_ids) where remaining still need fetching.
+    """
+    watchlist = load_watchlist()
+    covered = [rid for rid in reach_ids if watchlist_covers(watchlist, rid, start_time, fields)]
+    if not covered or not DUCKDB_AVAILABLE:
+        return [], pd.DataFrame(columns=fields), list(reach_ids)
+    try:
+        df = query_observations(reach_ids=covered, start_time=start_time, end_time=end_time)
+    except Exception:
+        # Nothing usable in the cache (e.g. refreshed with zero observations): fetch remotely
+        return [], pd.DataFrame(columns=fields), list(reach_ids)
+    failures = quality_failures(df, quality_rules) if quality_rules else {}
+    passed = quality_mask(df, quality_rules) if quality_rules else np.ones(len(df), dtype=bool)
+    dropped_by = {field: int(failed.sum()) for field, failed in failures.items()}
+    df = df[passed].reindex(columns=fields)
+    order = {rid: i for i, rid in enumerate(reach_ids)}
+    df = df.sort_values(['reach_id', 'time_str'], key=lambda c: c.map(order) if c.name == 'reach_id' else c)
+    df = df.reset_index(drop=True)
+    df.attrs.update(quality_dropped=int((~passed).sum()), quality_dropped_by=dropped_by)
+    geoms = {rid: load_reach_geometry(rid) for rid in covered}
+    records = df.astype(object).where(df.notna(), None).to_dict('records')
+    features = [
+        {"type": "Feature", "properties": rec, "geometry": geoms[str(rec['reach_id'])]}
+        for rec in records
+    ]
+    return features, df, [rid for rid in reach_ids if rid not in covered]
+
+class WatchlistScheduler:
+    """
+    Daemon thread refreshing the watchlist now (via trigger()) and, when the
+    watchlist has auto_refresh enabled, every interval_hours.
+    """
+    def __init__(self):
+        self.wake = threading.Event()
+        self.force = False
+        self.last_errors = []
+        self.running = False
+        threading.Thread(target=self._loop, daemon=True, name="hydrocron-watchlist").start()
+
+    def trigger(self):
+        self.force = True
+        self.wake.set()
+
+    def _loop(self):
+        while True:
+            watchlist = load_watchlist()
+            due_at = watchlist.get("last_run", 0) + watchlist["interval_hours"] * 3600
+            due = watchlist.get("auto_refresh") and time.time() >= due_at
+            if watchlist["reach_ids"] and (self.force or due):
+                self.force = False
+                self.running = True
+                try:
+                    self.last_errors = refresh_watchlist(watchlist)
+                except Exception as e:
+                    self.last_errors = [str(e)]
+                finally:
+                    self.running = False
+                continue
+            self.wake.wait(timeout=min(max(due_at - time.time(), 5), 300))
+            self.wake.clear()
+
+@st.cache_resource
+def watchlist_scheduler() -> WatchlistScheduler:
+    """One scheduler per process, started from the Watchlist panel (never on import)."""
+    return WatchlistScheduler()
+
+# ----------------------------
+# Run profiling (sampling profiler + tracemalloc)
+# ----------------------------
+PROFILER_IDLE_FILES = ("threading.py", "queue.py", os.path.join("concurrent", "futures", "thread.py"))
+
+@st.cache_resource
+def _tracemalloc_users():
+    """Process-wide count of profilers needing tracemalloc, and whether we started it."""
+    return {"lock": threading.Lock(), "count": 0, "owned": False}
+
+def acquire_tracemalloc():
+    """Start tracing for the first user (unless something else already traces)."""
+    users = _tracemalloc_users()
+    with users["lock"]:
+        if users["count"] == 0:
+            users["owned"] = not tracemalloc.is_tracing()
+            if users["owned"]:
+                tracemalloc.start()
+        users["count"] += 1
+
+def release_tracemalloc():
+    """Stop tracing when the last user leaves, and only if acquire_tracemalloc started it."""
+    users = _tracemalloc_users()
+    with users["lock"]:
+        users["count"] = max(0, users["count"] - 1)
+        if users["count"] == 0 and users["owned"]:
+            tracemalloc.stop()
+            users["owned"] = False
+
+class RunProfiler:
+    """
+    Profiles one Run: a background thread samples the script thread and this run's
+    fetch workers (threads named `thread_prefix`...) every `interval` seconds,
+    tracemalloc records allocation sites, and lap() records stage timings. Results
+    export as speedscope JSON or folded stacks. Tracing is shared by concurrent
+    profilers, so allocation figures can include other sessions' allocations.
+    """
+    def __init__(self, interval: float = 0.005, top_n: int = 25):
+        self.interval = interval
+        self.top_n = top_n
+        self.stacks = Counter()
+        self.laps = []
+        self.snapshot = None
+        self.peak_bytes = 0
+        self.thread_prefix = f"hydrocron-run-{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        self.started = self._last_lap = time.perf_counter()
+        acquire_tracemalloc()
+        self._base_bytes = tracemalloc.get_traced_memory()[0]
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True, name="hydrocron-profiler")
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._sampler.join()
+        self.elapsed = time.perf_counter() - self.started
+        try:
+            if tracemalloc.is_tracing():
+                self.snapshot = tracemalloc.take_snapshot().filter_traces([
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+                ])
+                self.peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - self._base_bytes)
+        finally:
+            release_tracemalloc()
+        return False
+
+    def lap(self, name: str):
+        """Close the current stage, attributing the time since the previous lap to `name`."""
+        now = time.perf_counter()
+        self.laps.append((name, now - self._last_lap))
+        self._last_lap = now
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            tracked = {self.thread_id} | {
+                t.ident for t in threading.enumerate() if t.name.startswith(self.thread_prefix)
+            }
+            for tid, frame in sys._current_frames().items():
+                if tid not in tracked:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                # skip idle threads (blocked on locks / empty work queues)
+                if stack and not stack[0][1].endswith(PROFILER_IDLE_FILES):
+                    self.stacks[tuple(reversed(stack))] += 1
+
+    def hot_functions(self) -> pd.DataFrame:
+        """Top functions by self samples (leaf) with their inclusive share."""
+        total = sum(self.stacks.values()) or 1
+        own, inclusive = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            own[stack[-1]] += n
+            for frame in set(stack):
+                inclusive[frame] += n
+        rows = [{
+            "function": name, "location": f"{os.path.basename(file)}:{line}",
+            "self %": round(100 * n / total, 1), "total %": round(100 * inclusive[(name, file, line)] / total, 1),
+        } for (name, file, line), n in own.most_common(self.top_n)]
+        return pd.DataFrame(rows)
+
+    def allocation_sites(self) -> pd.DataFrame:
+        """Top allocation sites still alive at the end of the run."""
+        stats = self.snapshot.statistics("lineno")[:self.top_n] if self.snapshot else []
+        return pd.DataFrame([{
+            "site": f"{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno}",
+            "size (MB)": round(s.size / 1e6, 3), "blocks": s.count,
+        } for s in stats])
+
+    def stage_timings(self) -> pd.DataFrame:
+        return pd.DataFrame([{"stage": name, "seconds": round(sec, 3)} for name, sec in self.laps])
+
+    def folded(self) -> str:
+        """Brendan Gregg folded stacks (input for flamegraph.pl / speedscope / inferno)."""
+        return "\n".join(
+            ";".join(f"{name} ({os.path.basename(file)}:{line})" for name, file, line in stack) + f" {n}"
+            for stack, n in self.stacks.items()
+        )
+
+    def speedscope(self) -> str:
+        """Sampled profile in speedscope's JSON file format."""
+        frames, index = [], {}
+        samples, weights = [], []
+        for stack, n in self.stacks.items():
+            ids = []
+            for name, file, line in stack:
+                key = (name, file, line)
+                if key not in index:
+                    index[key] = len(frames)
+                    frames.append({"name": name, "file": file, "line": line})
+                ids.append(index[key])
+            samples.append(ids)
+            weights.append(n * self.interval * 1000)
+        return json.dumps({
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled", "name": "Hydrocron run", "unit": "milliseconds",
+                "startValue": 0, "endValue": sum(weights), "samples": samples, "weights": weights,
+            }],
+            "name": "Hydrocron run",
+            "exporter": "hydrocron_st",
+        })
+
+def render_profile(profiler: RunProfiler):
+    """Stage timings, hot functions, allocation sites and flame graph downloads."""
+    st.text("")
+    st.markdown("### Profile")
+    st.caption(
+        f"{profiler.elapsed:.2f} s total, {sum(profiler.stacks.values()):,} samples, "
+        f"peak traced memory {profiler.peak_bytes / 1e6:,.1f} MB."
+    )
+    pcol1, pcol2 = st.columns(2)
+    with pcol1:
+        st.write("**Stage timings**", profiler.stage_timings())
+        st.write("**Hot functions**", profiler.hot_functions())
+    with pcol2:
+        st.write("**Top allocation sites**", profiler.allocation_sites())
+        st.download_button(
+            "Download flame graph (speedscope JSON)",
+            data=profiler.speedscope().encode('utf-8'),
+            file_name="hydrocron_profile.speedscope.json",
+            mime="application/json",
+            icon=":material/download:"
+        )
+        st.download_button(
+            "Download folded stacks",
+            data=profiler.folded().encode('utf-8'),
+            file_name="hydrocron_profile.folded.txt",
+            mime="text/plain",
+            icon=":material/download:"
+        )
+        st.caption("Open the JSON at https://www.speedscope.app to browse the flame graph.")
+
+# ----------------------------
+# Per-reach archive export (bounded memory)
+# ----------------------------
+EXPORTS_DIR = os.path.join(CACHE_DIR, "exports")
+
+class ReachArchiveWriter:
+    """
+    Zip archive with one gzip-compressed CSV per reach (reaches/<id>.csv.gz) and a
+    manifest.json of row counts, time ranges and SHA-256 checksums. Reaches are
+    written as they arrive, so only one reach is ever held in memory.
+    """
+    def __init__(self, fileobj, meta: dict | None = None):
+        self.zip = zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_STORED)
+        self.meta = meta or {}
+        self.entries = []
+
+    def add(self, reach_id, df: pd.DataFrame):
+        payload = gzip.compress(df.drop(columns=['ID'], errors='ignore').to_csv(index=False).encode('utf-8'), mtime=0)
+        name = f"reaches/{reach_id}.csv.gz"
+        self.zip.writestr(name, payload)
+        times = df['time_str'].dropna() if 'time_str' in df.columns else pd.Series(dtype=object)
+        self.entries.append({
+            "reach_id": str(reach_id), "file": name, "rows": len(df),
+            "first_time": str(times.min()) if len(times) else None,
+            "last_time": str(times.max()) if len(times) else None,
+            "bytes": len(payload), "sha256": hashlib.sha256(payload).hexdigest(),
+        })
+
+    def close(self) -> dict:
+        manifest = {
+            **self.meta,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "reaches": len(self.entries),
+            "rows": sum(e["rows"] for e in self.entries),
+            "files": self.entries,
+        }
+        self.zip.writestr("manifest.json", json.dumps(manifest, indent=1))
+        self.zip.close()
+        return manifest
+
+def iter_fetch(reach_ids, start_time, end_time, fields, quality_rules=None, network_mode=None,
+               limiter=None, window: int | None = None):
+    """
+    Yield (reach_id, geojson, df, error) as reaches complete. At most `window`
+    reaches are pending at once, so finished results never pile up in memory.
+    """
+    window = window or 2 * HYDROCRON_MAX_INFLIGHT
+    requested = fields.split(',')
+    rule_fields = [f for f in (quality_rules or {}) if f not in requested]
+    fetch_fields = ','.join(requested + rule_fields)
+    queue_ids = iter(reach_ids)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(reach_ids), HYDROCRON_MAX_INFLIGHT))) as pool:
+        pending = {}
+
+        def refill():
+            while len(pending) < window:
+                rid = next(queue_ids, None)
+                if rid is None:
+                    return
+                pending[pool.submit(fetch_data, rid, start_time, end_time, fetch_fields,
+                                    quality_rules, network_mode, limiter)] = rid
+
+        refill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rid = pending.pop(future)
+                try:
+                    geojson_data, df, _, _ = future.result()
+                    yield rid, geojson_data, df.drop(columns=rule_fields), None
+                except Exception as e:
+                    yield rid, None, None, e
+            refill()
+
+def export_reach_archive(fileobj, reach_ids=None, start_time=None, end_time=None, fields=None,
+                         quality_rules=None, network_mode=None, df: pd.DataFrame | None = None,
+                         progress=None) -> dict:
+    """
+    Write a per-reach archive to fileobj, either from an existing results table (df)
+    or by streaming a fresh fetch of reach_ids. Returns the manifest.
+    """
+    meta = {"start_time": start_time, "end_time": end_time, "fields": fields, "errors": []}
+    writer = ReachArchiveWriter(fileobj, meta)
+    if df is not None:
+        groups = list(df.groupby(df['reach_id'].astype(str), sort=False))
+        for i, (rid, sub) in enumerate(groups, start=1):
+            writer.add(rid, sub)
+            if progress:
+                progress(i, len(groups))
+    else:
+        for i, (rid, _, reach_df, error) in enumerate(
+            iter_fetch(reach_ids, start_time, end_time, fields, quality_rules, network_mode), start=1
+        ):
+            if error is not None:
+                meta["errors"].append(f"{rid}: {error}")
+            elif not reach_df.empty:
+                writer.add(rid, reach_df)
+            if progress:
+                progress(i, len(reach_ids))
+    return writer.close()
+
+def new_export_path() -> str:
+    """Path for a new archive; exports older than a day are removed."""
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    for old in glob.glob(os.path.join(EXPORTS_DIR, "*.zip")):
+        if os.path.getmtime(old) < time.time() - 86400:
+            os.remove(old)
+    return os.path.join(EXPORTS_DIR, f"hydrocron_reaches_{time.strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:6]}.zip")
+
 def get_geojson_bounds(geojson_data):
     min_lon, min_lat, max_lon, max_lat = float('inf'), float('inf'), float('-inf'), float('-inf')
     if geojson_data.get('type') == 'FeatureCollection':
@@ -157,7 +1387,165 @@ def get_geojson_bounds(geojson_data):
         raise ValueError("No valid geometries found in GeoJSON data")
     return min_lon, min_lat, max_lon, max_lat
 
-def create_map(geojson_data, df, start_time, end_time):
+# ----------------------------
+# Map payload encoding
+# ----------------------------
+MAP_FIELDS = ["reach_id", "river_name", "continent_id", "time_str", "wse"]
+
+def encode_topojson(geojson_data, quantization: int = 100_000, fields=MAP_FIELDS) -> dict:
+    """
+    Encode a FeatureCollection as quantized TopoJSON for the map.
+    - Identical geometries (every observation of a reach repeats the reach line)
+      share one arc, so each reach's coordinates are embedded once.
+    - Coordinates are simplified to one quantization step (sub-pixel at the zoom
+      that fits the data) then delta-encoded as integers.
+    - Properties are trimmed to the popup/tooltip fields plus a precomputed `color`.
+    """
+    features = [f for f in geojson_data.get('features', []) if f.get('geometry')]
+    min_lon, min_lat, max_lon, max_lat = get_geojson_bounds({"type": "FeatureCollection", "features": features})
+    kx = max(max_lon - min_lon, 1e-9) / (quantization - 1)
+    ky = max(max_lat - min_lat, 1e-9) / (quantization - 1)
+    tolerance = max(kx, ky)
+
+    def quantize(coords):
+        q = np.rint((np.asarray(coords, dtype='float64')[:, :2] - (min_lon, min_lat)) / (kx, ky)).astype('int64')
+        return q
+
+    arcs = []
+    arc_index = {}
+
+    def arc_for(coords):
+        raw = np.asarray(coords, dtype='float64')
+        key = hashlib.md5(raw.tobytes()).digest()
+        if key not in arc_index:
+            line = shape({"type": "LineString", "coordinates": raw[:, :2]}).simplify(tolerance, preserve_topology=False)
+            q = quantize(np.asarray(line.coords) if not line.is_empty else raw)
+            delta = np.vstack([q[:1], np.diff(q, axis=0)])
+            arc_index[key] = len(arcs)
+            arcs.append(delta.tolist())
+        return arc_index[key]
+
+    colors = {}
+    geometries = []
+    for feature in features:
+        props = feature.get('properties') or {}
+        rid = str(props.get('reach_id', 'na'))
+        if rid not in colors:
+            colors[rid] = nice_color_for_reach(rid)
+        out_props = {}
+        for field in fields:
+            value = props.get(field)
+            if field not in TEXT_FIELDS and value is not None:
+                value = pd.to_numeric(value, errors='coerce')
+                value = None if pd.isna(value) or value in FILL_VALUES else float(value)
+            out_props[field] = value
+        out_props['color'] = colors[rid]
+
+        geom = feature['geometry']
+        gtype = geom.get('type')
+        if gtype == 'LineString':
+            topo_geom = {"type": "LineString", "arcs": [arc_for(geom['coordinates'])]}
+        elif gtype == 'MultiLineString':
+            topo_geom = {"type": "MultiLineString", "arcs": [[arc_for(c)] for c in geom['coordinates']]}
+        elif gtype == 'Point':
+            topo_geom = {"type": "Point", "coordinates": quantize([geom['coordinates']])[0].tolist()}
+        elif gtype == 'MultiPoint':
+            topo_geom = {"type": "MultiPoint", "coordinates": quantize(geom['coordinates']).tolist()}
+        else:
+            continue
+        topo_geom['properties'] = out_props
+        geometries.append(topo_geom)
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": [kx, ky], "translate": [min_lon, min_lat]},
+        "objects": {"reaches": {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": arcs,
+    }
+
+class _ColorTopoJson(folium.TopoJson):
+    """
+    folium.TopoJson styled in the browser: one shared base style plus each
+    feature's `color` property, instead of a style dict embedded in every feature.
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }}_data = {{ this.data|tojson }};
+            var {{ this.get_name() }} = L.geoJson(
+                topojson.feature(
+                    {{ this.get_name() }}_data,
+                    {{ this.get_name() }}_data{{ this._safe_object_path }}
+                ),
+                {
+                    style: function(feature) {
+                        return Object.assign({}, {{ this.base_style|tojson }}, {color: feature.properties.color});
+                    },
+                }
+            ).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, data, object_path, base_style: dict | None = None, **kwargs):
+        super().__init__(data, object_path, **kwargs)
+        self.base_style = base_style or {}
+
+    def style_data(self):
+        """No per-feature styles; the layer's style function reads `color`."""
+
+class _TopoHighlight(MacroElement):
+    """Hover highlight for a folium.TopoJson layer (TopoJson has no highlight_function)."""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this._parent.get_name() }}.on('mouseover', function(e) {
+                e.layer.setStyle({{ this.style|tojson }});
+            });
+            {{ this._parent.get_name() }}.on('mouseout', function(e) {
+                {{ this._parent.get_name() }}.resetStyle(e.layer);
+            });
+        {% endmacro %}
+    """)
+
+    def __init__(self, **style):
+        super().__init__()
+        self._name = "TopoHighlight"
+        self.style = style
+
+def add_flag_markers(m, geojson_data, flagged_df: pd.DataFrame, field: str, max_rows: int = 10):
+    """One marker per reach with flagged observations, placed on the reach line."""
+    flagged_df = flagged_df[flagged_df['anomaly'] | flagged_df['step']]
+    if flagged_df.empty:
+        return
+    geoms = {}
+    for feature in geojson_data.get('features', []):
+        rid = str(feature.get('properties', {}).get('reach_id'))
+        if rid not in geoms and feature.get('geometry'):
+            geoms[rid] = feature['geometry']
+    layer = folium.FeatureGroup(name="Flagged observations")
+    for rid, rows in flagged_df.groupby(flagged_df['reach_id'].astype(str), sort=False):
+        if rid not in geoms:
+            continue
+        point = shape(geoms[rid]).representative_point()
+        has_step = bool(rows['step'].any())
+        lines = "".join(
+            f"<tr><td>{esc(r.time_str)}</td><td>{'step' if r.step else 'anomaly'}</td>"
+            f"<td>{getattr(r, field):.3f}</td></tr>"
+            for r in rows.sort_values('time_str').tail(max_rows).itertuples()
+        )
+        folium.CircleMarker(
+            location=[point.y, point.x],
+            radius=8,
+            color='#ffd400' if has_step else '#ff4d4d',
+            fill=True,
+            fill_opacity=0.8,
+            tooltip=f"{esc(rid)}: {len(rows)} flagged",
+            popup=folium.Popup(
+                f"<b>Reach {esc(rid)}</b><table><tr><th>Time</th><th>Flag</th><th>{esc(field)}</th></tr>{lines}</table>",
+                max_width=420
+            ),
+        ).add_to(layer)
+    layer.add_to(m)
+
+def create_map(geojson_data, df, start_time, end_time, flags=None):
     limits = get_geojson_bounds(geojson_data)
     m = folium.Map(
         zoom_start=4,
@@ -184,40 +1572,39 @@ def create_map(geojson_data, df, start_time, end_time):
         opacity=0.5
     ).add_to(m)
 
-    # Neon color per reach for consistency with the time series
-    def style_fn(feature):
-        rid = str(feature.get('properties', {}).get('reach_id', 'na'))
-        c = nice_color_for_reach(rid)
-        return {"color": c, "weight": 4, "opacity": 0.95, "fill": False}
-
-    def highlight_fn(feature):
-        return {"weight": 6, "opacity": 1.0}
+    # Shared-arc, quantized TopoJSON; colors are precomputed per reach as properties
+    # and applied in the browser on top of one shared style
+    topology = encode_topojson(geojson_data)
 
-    gj = folium.GeoJson(
-        geojson_data,
+    tj = _ColorTopoJson(
+        topology,
+        object_path="objects.reaches",
+        base_style={"weight": 4, "opacity": 0.95, "fill": False},
         name="Reach Features",
-        style_function=style_fn,
-        highlight_function=highlight_fn,
         tooltip=folium.GeoJsonTooltip(
             fields=["reach_id", "river_name"],
             aliases=["Reach ID", "River"],
             labels=True,
             sticky=True
-        ),
-        popup=folium.GeoJsonPopup(
-            fields=["reach_id", "river_name", "continent_id", "time_str", "wse"],
-            aliases=["Reach ID", "River", "Continent", "Time", "WSE"],
-            localize=True,
-            labels=True,
-            max_width=420,
-            parse_html=False,
-            sticky=False,
-            show=False
         )
     )
-    gj.add_to(m)
+    folium.GeoJsonPopup(
+        fields=["reach_id", "river_name", "continent_id", "time_str", "wse"],
+        aliases=["Reach ID", "River", "Continent", "Time", "WSE"],
+        localize=True,
+        labels=True,
+        max_width=420,
+        parse_html=False,
+        sticky=False,
+        show=False
+    ).add_to(tj)
+    _TopoHighlight(weight=6, opacity=1.0).add_to(tj)
+    tj.add_to(m)
 
-    m.fit_bounds(m.get_bounds(), padding=(50, 50))
+    if flags is not None:
+        add_flag_markers(m, geojson_data, df.join(flags), flags.attrs.get('field', 'wse'))
+
+    m.fit_bounds([[limits[1], limits[0]], [limits[3], limits[2]]], padding=(50, 50))
 
     folium.plugins.Fullscreen(
         position="topright",
@@ -228,6 +1615,620 @@ def create_map(geojson_data, df, start_time, end_time):
 
     return m
 
+# ----------------------------
+# WSE time series
+# ----------------------------
+def wse_series(df: pd.DataFrame) -> pd.DataFrame:
+    """Plottable WSE points: numeric, finite, UTC-timestamped, sorted by reach then time."""
+    # Clean & prepare
+    ts = df[['reach_id', 'river_name', 'time_str', 'wse']].copy()
+    ts['reach_id'] = ts['reach_id'].astype(str)
+
+    # numeric WSE, drop sentinel + non-finite
+    ts['wse'] = pd.to_numeric(ts['wse'], errors='coerce').replace(FILL_VALUE, np.nan)
+    ts = ts.replace([np.inf, -np.inf], np.nan).dropna(subset=['wse'])
+
+    # tz-aware UTC timestamps
+    ts['time'] = pd.to_datetime(ts['time_str'], errors='coerce', utc=True)
+    return ts.dropna(subset=['time']).sort_values(['reach_id', 'time'])
+
+def wse_figure(ts: pd.DataFrame, data_key: str, flags: pd.DataFrame | None = None):
+    """
+    WSE time series, one trace per reach, cached by data hash. x (epoch ms on a
+    date axis) and y are float64 NumPy arrays, which Plotly serialises as base64
+    typed arrays instead of JSON number lists; reach/river go in the hover template.
+    Flagged anomalies and step changes are overlaid as two extra marker traces.
+    """
+    def build():
+        fig = go.Figure()
+        epoch_ms_all = (ts['time'].dt.tz_convert('UTC').dt.tz_localize(None)
+                        .astype('int64') // 1_000_000).to_numpy(dtype='float64')
+        wse_all = ts['wse'].to_numpy(dtype='float64')
+        rids = ts['reach_id'].to_numpy()
+        # ts is sorted by reach, so each reach is one contiguous slice
+        starts = np.flatnonzero(np.r_[True, rids[1:] != rids[:-1]])
+        ends = np.r_[starts[1:], len(rids)]
+        rivers = ts['river_name'].astype(str).to_numpy()
+        for a, b in zip(starts, ends):
+            rid = str(rids[a])
+            color = nice_color_for_reach(rid)
+            fig.add_trace(go.Scatter(
+                x=epoch_ms_all[a:b],
+                y=wse_all[a:b],
+                mode='lines+markers',
+                name=rid,
+                line=dict(width=2, color=color),
+                marker=dict(size=6, line=dict(width=0), color=color),
+                hovertemplate=f"<b>Reach:</b> {esc(rid)}<br>"
+                              f"<b>River:</b> {esc(rivers[a])}<br>"
+                              "<b>Time (UTC):</b> %{x|%Y-%m-%d %H:%M:%S}<br>"
+                              "<b>WSE (m):</b> %{y:.3f}<extra></extra>",
+            ))
+
+        if flags is not None:
+            ts_flags = flags.reindex(ts.index)
+            for column, name, symbol, color in (
+                ('anomaly', 'Anomaly', 'circle-open', '#ff4d4d'),
+                ('step', 'Step change', 'diamond', '#ffd400'),
+            ):
+                hit = ts_flags[column].fillna(False).to_numpy(dtype=bool)
+                if not hit.any():
+                    continue
+                fig.add_trace(go.Scatter(
+                    x=epoch_ms_all[hit],
+                    y=wse_all[hit],
+                    mode='markers',
+                    name=name,
+                    customdata=rids[hit].astype(str),
+                    marker=dict(size=13, symbol=symbol, color=color, line=dict(width=2, color=color)),
+                    hovertemplate=f"<b>{name}</b><br>"
+                                  "<b>Reach:</b> %{customdata}<br>"
+                                  "<b>Time (UTC):</b> %{x|%Y-%m-%d %H:%M:%S}<br>"
+                                  "<b>WSE (m):</b> %{y:.3f}<extra></extra>",
+                ))
+
+        fig.update_layout(
+            template="plotly_dark",
+            height=420,
+            margin=dict(l=40, r=20, t=50, b=40),
+            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0),
+            xaxis=dict(title="Date (UTC)", type="date", showgrid=True, gridwidth=0.3),
+            yaxis=dict(title="Water Surface Elevation (m)", showgrid=True, gridwidth=0.3),
+            # paper_bgcolor="#11151a",
+            # plot_bgcolor="#11151a",
+        )
+        return fig
+    flags_key = None if flags is None else frame_fingerprint(flags)
+    return cached_result((data_key, flags_key, "wse_figure"), build)
+
+# ----------------------------
+# Local observation cache + SQL engine
+# ----------------------------
+OBS_DIR = os.path.join(CACHE_DIR, "obs")
+OBS_RETENTION_DAYS = float(os.environ.get("HYDROCRON_OBS_RETENTION_DAYS", "30"))
+
+def _sql_str(value) -> str:
+    """Quote a value as a SQL string literal."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+def coerce_numeric_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Return a copy of df with every non-text field converted to a numeric dtype."""
+    out = df.copy()
+    for col in out.columns:
+        if col in TEXT_FIELDS:
+            out[col] = out[col].astype("string")
+        else:
+            out[col] = pd.to_numeric(out[col], errors='coerce')
+    return out
+
+@st.cache_resource
+def _cache_write_lock():
+    """Serialises read-merge-write of cache files across sessions, jobs and the watchlist."""
+    return threading.Lock()
+
+def cache_observations(df: pd.DataFrame) -> int:
+    """
+    Merge fetched observations into the local Parquet cache.
+    Layout is hive-partitioned by reach (obs/reach_id=<id>/data.parquet) so reach
+    filters prune whole files; rows are time-sorted so time filters prune row groups.
+    Returns the number of reaches written.
+    """
+    if df.empty or 'reach_id' not in df.columns or 'time_str' not in df.columns:
+        return 0
+    typed = coerce_numeric_columns(df.drop(columns=['ID'], errors='ignore'))
+    written = 0
+    for rid, sub in typed.groupby('reach_id', sort=False):
+        rid = str(rid)
+        if not rid.isalnum():
+            continue
+        part_dir = os.path.join(OBS_DIR, f"reach_id={rid}")
+        os.makedirs(part_dir, exist_ok=True)
+        path = os.path.join(part_dir, "data.parquet")
+        sub = sub.drop(columns=['reach_id']).drop_duplicates(subset=['time_str'], keep='last').set_index('time_str')
+        with _cache_write_lock():
+            if os.path.exists(path):
+                # new values win; fields the new rows lack are kept from the cache
+                sub = sub.combine_first(pd.read_parquet(path).set_index('time_str'))
+            sub = sub.sort_index(kind='stable').reset_index()
+            tmp_path = path + ".tmp"
+            sub.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        written += 1
+    return written
+
+def prune_observation_cache(max_age_days: float = OBS_RETENTION_DAYS, keep=()) -> int:
+    """Remove reach partitions not written for max_age_days (reaches in keep are never removed)."""
+    cutoff = time.time() - max_age_days * 86400
+    keep = {str(rid) for rid in keep}
+    removed = 0
+    for path in glob.glob(os.path.join(OBS_DIR, "reach_id=*", "data.parquet")):
+        part_dir = os.path.dirname(path)
+        if os.path.basename(part_dir).split("=", 1)[1] in keep:
+            continue
+        with _cache_write_lock():
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(part_dir, ignore_errors=True)
+        removed += 1
+    return removed
+
+@st.cache_resource
+def _cache_writer():
+    """Single background writer for Run results: (executor, data hashes already written)."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="hydrocron-cache"), set()
+
+def cache_in_background(df: pd.DataFrame, data_key: str):
+    """Merge df into the observation cache off the script thread, then expire old partitions."""
+    pool, written = _cache_writer()
+    if data_key in written:
+        return
+    written.add(data_key)
+
+    def write():
+        try:
+            cache_observations(df)
+            prune_observation_cache(keep=load_watchlist()["reach_ids"])
+        except Exception as e:
+            written.discard(data_key)
+            warnings.warn(f"Could not update the local observation cache: {e}")
+
+    pool.submit(write)
+
+def query_observations(sql: str = "SELECT * FROM obs", reach_ids=None, start_time=None,
+                       end_time=None, quality=None) -> pd.DataFrame:
+    """
+    Run a single read-only SELECT against the cached observations, exposed as the
+    view `obs` over the Parquet scan. reach_ids / start_time / end_time / quality
+    ({flag: max allowed value}) are part of the view, and DuckDB pushes them and
+    the query's own predicates into the scan, so only matching partitions and row
+    groups are read. The SQL runs with file access limited to the cache directory
+    and the configuration locked: no other file reads or writes, COPY, ATTACH or SET.
+    """
+    if not DUCKDB_AVAILABLE:
+        raise RuntimeError("duckdb is not installed; the SQL engine is unavailable.")
+    pattern = os.path.join(OBS_DIR, "reach_id=*", "data.parquet")
+    if not glob.glob(pattern):
+        raise ValueError("No cached observations yet. Run a query to populate the cache.")
+
+    source = (
+        f"read_parquet({_sql_str(pattern)}, hive_partitioning=true, union_by_name=true, "
+        f"hive_types={{'reach_id': VARCHAR}})"
+    )
+    con = duckdb.connect()
+    try:
+        statements = con.extract_statements(sql)
+        if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+            raise ValueError("Only a single SELECT (or WITH ... SELECT) statement is allowed.")
+        columns = {row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()}
+        where = []
+        if reach_ids:
+            where.append(f"reach_id IN ({', '.join(_sql_str(r) for r in reach_ids)})")
+        if start_time:
+            where.append(f"time_str >= {_sql_str(start_time)}")
+        if end_time:
+            where.append(f"time_str <= {_sql_str(end_time)}")
+        for flag, max_value in (quality or {}).items():
+            if flag not in columns:
+                raise ValueError(f"Quality field '{flag}' is not present in the cache.")
+            where.append(f'"{flag}" <= {float(max_value)}')
+        where_sql = f" WHERE {' AND '.join(where)}" if where else ""
+        con.execute(f"SET allowed_directories = [{_sql_str(os.path.join(OBS_DIR, ''))}]")
+        con.execute("SET enable_external_access = false")
+        con.execute(f"CREATE TEMP VIEW obs AS SELECT * FROM {source}{where_sql}")
+        con.execute("SET lock_configuration = true")
+        return con.execute(sql).df()
+    finally:
+        con.close()
+
+# ----------------------------
+# Result cache (keyed by data hash) + aggregation
+# ----------------------------
+AGG_STATS = ['mean', 'median', 'min', 'max', 'count', 'std']
+AGG_PERIODS = {"Daily": "D", "Monthly": "M", "Per cycle": "cycle"}
+RESULT_CACHE_BYTES = int(float(os.environ.get("HYDROCRON_RESULT_CACHE_MB", "256")) * 2**20)
+
+@st.cache_resource
+def _result_store():
+    """Process-wide LRU shared by all sessions (survives reruns, unlike module globals)."""
+    return {"lock": threading.Lock(), "items": OrderedDict(), "bytes": 0}
+
+def estimate_bytes(value) -> int:
+    """Approximate memory held by a cached value (frames, arrays, figures, HTML and containers of them)."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, go.Figure):
+        return estimate_bytes(value.to_plotly_json())
+    if isinstance(value, dict):
+        return sum(estimate_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_bytes(v) for v in value)
+    if hasattr(value, "__dict__"):
+        return estimate_bytes(vars(value))
+    return sys.getsizeof(value)
+
+def cached_result(key, compute, max_items: int = 64, max_bytes: int | None = None):
+    """
+    Return the cached value for key, computing and storing it on a miss. The LRU
+    is bounded by count and by estimated size; a value larger than the whole
+    budget is returned without being stored.
+    """
+    max_bytes = RESULT_CACHE_BYTES if max_bytes is None else max_bytes
+    store = _result_store()
+    with store["lock"]:
+        if key in store["items"]:
+            store["items"].move_to_end(key)
+            return store["items"][key][0]
+    value = compute()
+    size = estimate_bytes(value)
+    if size > max_bytes:
+        return value
+    with store["lock"]:
+        if key in store["items"]:
+            store["bytes"] -= store["items"].pop(key)[1]
+        store["items"][key] = (value, size)
+        store["bytes"] += size
+        while len(store["items"]) > max_items or store["bytes"] > max_bytes:
+            store["bytes"] -= store["items"].popitem(last=False)[1][1]
+    return value
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """Content hash of a DataFrame (columns + values), computed vectorized."""
+    h = hashlib.md5(",".join(map(str, df.columns)).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+def numeric_fields(df: pd.DataFrame) -> list[str]:
+    """Columns that hold measurements (excludes text fields and identifiers)."""
+    skip = TEXT_FIELDS | {'ID', 'time', 'time_tai', 'cycle_id', 'pass_id'}
+    return [c for c in df.columns if c not in skip]
+
+def prepare_numeric_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    One-off conversion of raw rows to typed columns: UTC time, float measurements
+    with the fill value masked. Everything downstream groups on this frame.
+    """
+    out = pd.DataFrame({'reach_id': df['reach_id'].astype(str)})
+    out['time'] = pd.to_datetime(df['time_str'], errors='coerce', utc=True, format='ISO8601')
+    for col in ('cycle_id', 'pass_id'):
+        if col in df.columns:
+            out[col] = pd.to_numeric(df[col], errors='coerce')
+    for col in numeric_fields(df):
+        values = pd.to_numeric(df[col], errors='coerce').astype('float64')
+        out[col] = values.mask(values <= FILL_VALUE)
+    return out.dropna(subset=['time'])
+
+def aggregate_observations(df: pd.DataFrame, value_fields, period: str = "D", stats=None,
+                           data_key: str | None = None) -> pd.DataFrame:
+    """
+    Per-reach statistics of value_fields per day ("D"), month ("M") or SWOT cycle ("cycle").
+    A single grouped aggregation over all reaches; the typed frame and every
+    (period, fields, stats) view are cached by the data hash. Pass data_key
+    (frame_fingerprint(df)) when it is already known to skip re-hashing.
+    """
+    stats = list(stats or AGG_STATS)
+    value_fields = list(value_fields)
+    data_key = data_key or frame_fingerprint(df)
+
+    def compute():
+        prepared = cached_result((data_key, "prepared"), lambda: prepare_numeric_frame(df))
+        if period == "cycle":
+            if 'cycle_id' not in prepared.columns:
+                raise ValueError("Per-cycle aggregation requires 'cycle_id' in the selected fields.")
+            key = prepared['cycle_id'].rename('cycle_id')
+        elif period == "M":
+            key = prepared['time'].dt.tz_localize(None).dt.to_period('M').dt.to_timestamp().rename('period')
+        else:
+            key = prepared['time'].dt.floor('D').rename('period')
+        grouped = prepared.groupby([prepared['reach_id'], key], sort=True)[value_fields].agg(stats)
+        grouped.columns = [f"{field}_{stat}" for field, stat in grouped.columns]
+        return grouped.reset_index()
+
+    return cached_result((data_key, "agg", period, tuple(value_fields), tuple(stats)), compute)
+
+
+# ----------------------------
+# Cross-reach alignment (time x reach matrix)
+# ----------------------------
+@dataclass
+class AlignedMatrix:
+    """
+    One field pivoted to a dense (overpass x reach) matrix. Columns are ordered
+    upstream -> downstream (descending p_dist_out); NaN where a reach was not observed.
+    """
+    field: str
+    reach_ids: np.ndarray     # (n_reaches,)
+    dist_out: np.ndarray      # (n_reaches,) metres from outlet, NaN if unknown
+    times: np.ndarray         # (n_rows,) datetime64[ns], earliest observation per row
+    values: np.ndarray        # (n_rows, n_reaches) float64
+
+def align_reaches(df: pd.DataFrame, field: str = 'wse', align: str = "cycle_pass",
+                  tolerance_hours: float = 6.0, data_key: str | None = None) -> AlignedMatrix:
+    """
+    Pivot combined_df into an AlignedMatrix. Rows are (cycle_id, pass_id) overpasses
+    when align="cycle_pass", else clusters of observation times no further than
+    tolerance_hours apart. Repeated observations in a cell are averaged.
+    """
+    data_key = data_key or frame_fingerprint(df)
+
+    def compute():
+        prepared = cached_result((data_key, "prepared"), lambda: prepare_numeric_frame(df))
+        if field not in prepared.columns:
+            raise ValueError(f"'{field}' is not a numeric field of the results.")
+        frame = prepared.dropna(subset=[field])
+        t = frame['time'].dt.tz_localize(None).to_numpy('datetime64[ns]')
+
+        if align == "cycle_pass":
+            if not {'cycle_id', 'pass_id'} <= set(frame.columns):
+                raise ValueError("Aligning on overpasses requires 'cycle_id' and 'pass_id' in the selected fields.")
+            frame = frame.dropna(subset=['cycle_id', 'pass_id'])
+            t = frame['time'].dt.tz_localize(None).to_numpy('datetime64[ns]')
+            keys = (frame['cycle_id'].to_numpy('int64') * 1000 + frame['pass_id'].to_numpy('int64'))
+            _, row_idx = np.unique(keys, return_inverse=True)
+        else:
+            order = np.argsort(t, kind='stable')
+            gaps = np.diff(t[order]) > np.timedelta64(int(tolerance_hours * 3600), 's')
+            cluster_sorted = np.concatenate([[0], np.cumsum(gaps)])
+            row_idx = np.empty(len(t), dtype='int64')
+            row_idx[order] = cluster_sorted
+
+        reach_ids, col_idx = np.unique(frame['reach_id'].to_numpy(str), return_inverse=True)
+        n_rows, n_cols = (row_idx.max() + 1 if len(row_idx) else 0), len(reach_ids)
+
+        sums = np.zeros((n_rows, n_cols))
+        counts = np.zeros((n_rows, n_cols))
+        np.add.at(sums, (row_idx, col_idx), frame[field].to_numpy('float64'))
+        np.add.at(counts, (row_idx, col_idx), 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = sums / counts
+
+        row_time = np.full(n_rows, np.iinfo('int64').max, dtype='int64')
+        np.minimum.at(row_time, row_idx, t.view('int64'))
+        row_order = np.argsort(row_time, kind='stable')
+
+        dist = np.full(n_cols, np.nan)
+        if 'p_dist_out' in frame.columns:
+            dist = frame.groupby(col_idx)['p_dist_out'].median().reindex(range(n_cols)).to_numpy('float64')
+        col_order = np.argsort(np.where(np.isnan(dist), -np.inf, -dist), kind='stable')
+
+        return AlignedMatrix(
+            field=field,
+            reach_ids=reach_ids[col_order],
+            dist_out=dist[col_order],
+            times=row_time[row_order].view('datetime64[ns]'),
+            values=values[np.ix_(row_order, col_order)],
+        )
+
+    return cached_result((data_key, "aligned", field, align, tolerance_hours), compute)
+
+def reach_gradients(aligned: AlignedMatrix) -> np.ndarray:
+    """
+    (n_rows, n_reaches - 1) gradient between each reach and its downstream neighbour,
+    in cm/km (positive = falling downstream). NaN where either side is missing.
+    """
+    drop = aligned.values[:, :-1] - aligned.values[:, 1:]
+    spacing = aligned.dist_out[:-1] - aligned.dist_out[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(spacing > 0, drop / spacing * 1e5, np.nan)
+
+def lag_correlations(aligned: AlignedMatrix, max_lag: int = 3, min_overlap: int = 5) -> np.ndarray:
+    """
+    NaN-aware Pearson correlation of every reach pair at row lags -max_lag..max_lag,
+    shape (2*max_lag + 1, n_reaches, n_reaches); [k, i, j] pairs reach i at row t
+    with reach j at row t + (k - max_lag). Each lag is a handful of matrix products.
+    """
+    values = aligned.values
+    n_rows, n_cols = values.shape
+    out = np.full((2 * max_lag + 1, n_cols, n_cols), np.nan)
+    for k, lag in enumerate(range(-max_lag, max_lag + 1)):
+        if abs(lag) >= n_rows:
+            continue
+        x = values[max(0, -lag):n_rows - max(0, lag)]
+        y = values[max(0, lag):n_rows - max(0, -lag)]
+        mx, my = ~np.isnan(x), ~np.isnan(y)
+        x0, y0 = np.where(mx, x, 0.0), np.where(my, y, 0.0)
+        mx, my = mx.astype('float64'), my.astype('float64')
+        n = mx.T @ my
+        sx, sy = x0.T @ my, mx.T @ y0
+        sxx, syy = (x0 ** 2).T @ my, mx.T @ (y0 ** 2)
+        sxy = x0.T @ y0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = sxy - sx * sy / n
+            corr = cov / np.sqrt((sxx - sx ** 2 / n) * (syy - sy ** 2 / n))
+        out[k] = np.where(n >= min_overlap, corr, np.nan)
+    return out
+
+def neighbour_lag_table(aligned: AlignedMatrix, max_lag: int = 3) -> pd.DataFrame:
+    """Best lag and correlation between each reach and its downstream neighbour."""
+    cube = lag_correlations(aligned, max_lag)
+    i = np.arange(len(aligned.reach_ids) - 1)
+    pairs = cube[:, i, i + 1]                       # (n_lags, n_pairs)
+    has_value = ~np.isnan(pairs).all(axis=0)
+    best = np.nanargmax(np.where(np.isnan(pairs), -np.inf, pairs), axis=0)
+    return pd.DataFrame({
+        'upstream_reach': aligned.reach_ids[:-1],
+        'downstream_reach': aligned.reach_ids[1:],
+        'best_lag_rows': np.where(has_value, best - max_lag, np.nan),
+        'correlation': np.where(has_value, pairs[best, i], np.nan),
+        'lag0_correlation': pairs[max_lag],
+    })
+
+# ----------------------------
+# Anomaly and step-change detection
+# ----------------------------
+# MADs from short windows are noisy, so thresholds sit above the textbook 3.5
+# (about 0.3% of pure-noise observations get flagged with these settings).
+ANOMALY_WINDOW = 15         # previous observations each point is scored against
+STEP_WINDOW = 3             # consecutive observations that must agree on a new level
+ANOMALY_Z = 5.0             # thresholds on the modified z-score 0.6745 * deviation / MAD
+STEP_Z = 5.0
+ANOMALY_MIN_PERIODS = 8
+ANOMALY_COLUMNS = ['anomaly_z', 'anomaly', 'step_z', 'step']
+
+@dataclass
+class ReachAnomalyState:
+    """Everything scored so far for one reach; new observations are scored from its tail."""
+    times: np.ndarray       # datetime64[ns], ascending
+    values: np.ndarray      # float64
+    scores: np.ndarray      # (n, 2) anomaly_z, step_z
+    flags: np.ndarray       # (n, 2) anomaly, step
+
+@st.cache_resource
+def _anomaly_store():
+    """Per-reach detection state shared across reruns: {(params, reach_id): ReachAnomalyState}."""
+    return {"lock": threading.Lock(), "reaches": OrderedDict()}
+
+def robust_scores(groups: np.ndarray, values: np.ndarray, window: int = ANOMALY_WINDOW,
+                  step_window: int = STEP_WINDOW, min_periods: int = ANOMALY_MIN_PERIODS,
+                  min_scale: float = 0.01):
+    """
+    Trailing robust scores for rows sorted by (group, time), all groups in one pass.
+    Each group is preceded by NaN padding so a single sliding window view never
+    crosses groups.
+    anomaly_z: deviation from the median of the previous `window` values, in MAD units.
+    step_z: median of the last `step_window` values against the median of the
+    `window` values before them, in units of that earlier MAD.
+    """
+    n = len(values)
+    if n == 0:
+        return np.empty(0), np.empty(0)
+    span = window + step_window
+    new_group = np.r_[True, groups[1:] != groups[:-1]]
+    pos = np.arange(n) + np.cumsum(new_group) * (span - 1)
+    padded = np.full(pos[-1] + 1, np.nan)
+    padded[pos] = values
+    view = sliding_window_view(padded, span)[pos - (span - 1)]
+
+    def median_mad(block):
+        med = np.nanmedian(block, axis=1)
+        mad = np.nanmedian(np.abs(block - med[:, None]), axis=1)
+        return med, np.maximum(mad, min_scale), np.sum(~np.isnan(block), axis=1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)   # all-NaN windows
+        ref_med, ref_mad, ref_n = median_mad(view[:, -window - 1:-1])
+        pre_med, pre_mad, pre_n = median_mad(view[:, :window])
+        post = view[:, window:]
+        post_med = np.nanmedian(post, axis=1)
+    anomaly_z = np.where(ref_n >= min_periods, 0.6745 * (values - ref_med) / ref_mad, np.nan)
+    complete = (pre_n >= min_periods) & ~np.isnan(post).any(axis=1)
+    step_z = np.where(complete, 0.6745 * (post_med - pre_med) / pre_mad, np.nan)
+    return anomaly_z, step_z
+
+def detect_anomalies(df: pd.DataFrame, field: str = 'wse', window: int = ANOMALY_WINDOW,
+                     step_window: int = STEP_WINDOW, z_threshold: float = ANOMALY_Z,
+                     step_threshold: float = STEP_Z, min_scale: float = 0.01,
+                     max_reaches: int = 50_000) -> pd.DataFrame:
+    """
+    Anomaly and step-change flags for every row of df (aligned on df.index).
+    A step is flagged on the observation that confirms a new level; observations
+    explained by that new level are not also flagged as anomalies.
+    State is kept per reach between calls: when a reach's earlier observations are
+    unchanged only the new ones are scored, otherwise the reach is rescored in full.
+    attrs['scored'] / attrs['reused'] count the rows of each kind.
+    """
+    params = (field, window, step_window, z_threshold, step_threshold, min_scale)
+    span = window + step_window
+    obs = pd.DataFrame({
+        'row': np.arange(len(df)),
+        'reach_id': df['reach_id'].astype(str).to_numpy(),
+        'time': pd.to_datetime(df['time_str'], errors='coerce', utc=True).dt.tz_localize(None).to_numpy(),
+        'value': pd.to_numeric(df[field], errors='coerce').to_numpy(dtype='float64'),
+    }).dropna(subset=['time']).sort_values(['reach_id', 'time'], kind='stable')
+    store = _anomaly_store()
+    with store["lock"]:
+        states = {rid: store["reaches"].get((params, rid)) for rid in obs['reach_id'].unique()}
+
+    scores = np.full((len(df), 2), np.nan)
+    flags = np.zeros((len(df), 2), dtype=bool)
+    groups, values, rows, context = [], [], [], []
+    carried = []        # (position of first new row, step active before it)
+    plan = []           # (reach_id, times, values, rows, state, n_reused)
+    offset = 0
+    o_rids = obs['reach_id'].to_numpy()
+    o_times = obs['time'].to_numpy(dtype='datetime64[ns]')
+    o_values = obs['value'].to_numpy()
+    o_rows = obs['row'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, o_rids[1:] != o_rids[:-1]]) if len(obs) else np.empty(0, dtype=int)
+    for g, (a, b) in enumerate(zip(starts, np.r_[starts[1:], len(obs)])):
+        rid, r_times, r_values, r_rows = o_rids[a], o_times[a:b], o_values[a:b], o_rows[a:b]
+        state = states.get(rid)
+        k = len(state.times) if state is not None else 0
+        if k and not (k <= len(r_times) and np.array_equal(r_times[:k], state.times)
+                      and np.array_equal(r_values[:k], state.values, equal_nan=True)):
+            state, k = None, 0
+        if k:
+            scores[r_rows[:k]] = state.scores
+            flags[r_rows[:k]] = state.flags
+        tail = state.values[-(span - 1):] if k else np.empty(0)
+        fresh = len(r_values) - k
+        if fresh:
+            if k:
+                carried.append((offset + len(tail), abs(np.nan_to_num(state.scores[-1, 1])) > step_threshold))
+            groups.append(np.full(len(tail) + fresh, g))
+            values.append(np.r_[tail, r_values[k:]])
+            rows.append(r_rows[k:])
+            context.append(np.r_[np.ones(len(tail), dtype=bool), np.zeros(fresh, dtype=bool)])
+            offset += len(tail) + fresh
+        plan.append((rid, r_times, r_values, r_rows, state, k))
+
+    if groups:
+        group_arr, value_arr, ctx = np.concatenate(groups), np.concatenate(values), np.concatenate(context)
+        anomaly_z, step_z = robust_scores(group_arr, value_arr, window, step_window, min_scale=min_scale)
+        active = np.abs(np.nan_to_num(step_z)) > step_threshold
+        prev_active = np.r_[False, active[:-1]] & (group_arr == np.r_[-1, group_arr[:-1]])
+        for position, was_active in carried:
+            prev_active[position] = was_active
+        explained = active & (np.sign(anomaly_z) == np.sign(step_z))
+        new_rows = np.concatenate(rows)
+        scores[new_rows] = np.column_stack([anomaly_z, step_z])[~ctx]
+        flags[new_rows] = np.column_stack([
+            (np.abs(np.nan_to_num(anomaly_z)) > z_threshold) & ~explained, active & ~prev_active
+        ])[~ctx]
+
+    with store["lock"]:
+        for rid, r_times, r_values, r_rows, state, k in plan:
+            key = (params, rid)
+            store["reaches"][key] = ReachAnomalyState(r_times, r_values, scores[r_rows], flags[r_rows])
+            store["reaches"].move_to_end(key)
+        while len(store["reaches"]) > max_reaches:
+            store["reaches"].popitem(last=False)
+
+    out = pd.DataFrame({
+        'anomaly_z': scores[:, 0], 'anomaly': flags[:, 0], 'step_z': scores[:, 1], 'step': flags[:, 1]
+    }, index=df.index)[ANOMALY_COLUMNS]
+    reused = sum(k for *_, k in plan)
+    out.attrs.update(field=field, reused=reused, scored=len(obs) - reused)
+    return out
+
 # ----------------------------
 # UI: Help / Inputs
 # ----------------------------
@@ -288,6 +2289,47 @@ with st.expander("$ \\large \\textrm {\\color{#F94C10} Inputs} $", expanded=True
         default=['reach_id', 'time_str', 'wse', 'width', 'river_name', 'continent_id']
     )
 
+    rule_labels = {f"{field} {op} {threshold}": field for field, (op, threshold) in QUALITY_RULES.items()}
+    selected_rules = st.multiselect(
+        ":violet[**Quality filters**]",
+        list(rule_labels),
+        default=[],
+        help="Observations failing any selected rule are dropped right after download, "
+             "before the table, map and plot are built. Observations without a value "
+             "for a flag are kept (not evaluated). Fill values are always masked."
+    )
+    quality_rules = {rule_labels[label]: QUALITY_RULES[rule_labels[label]] for label in selected_rules}
+
+    node_mode = st.checkbox(
+        ":violet[**Node-level profiles**]",
+        value=False,
+        help="Also fetch every node of each reach (about 50x more data than reaches) "
+             "and plot along-reach WSE profiles per overpass."
+    )
+
+    profile_run = st.checkbox(
+        ":violet[**Profile this run**]",
+        value=False,
+        help="Sample the Run pipeline (fetch, table, map, figure) and track allocations; "
+             "shows hot functions and allocation sites with a downloadable flame graph."
+    )
+
+    detect_changes = st.checkbox(
+        ":violet[**Flag anomalies and step changes**]",
+        value=False,
+        help="Score each reach against a rolling median/MAD of its previous observations; "
+             "spikes and sudden level shifts are flagged in the table, map and plot."
+    )
+    anomaly_candidates = [
+        f for f in selected_fields if f == 'wse' or (f.startswith('dschg_') and f.count('_') == 1 and not f.endswith('sf'))
+    ]
+    anomaly_field = st.selectbox("Field to scan", anomaly_candidates or ['wse']) if detect_changes else None
+
+    # Deployment setting only: visitors must not be able to start recording to disk
+    network_mode = HYDROCRON_MODE
+    if network_mode != "live":
+        st.caption(f":violet[**Network mode:**] {network_mode} (set by the HYDROCRON_MODE environment variable)")
+
     if not all(field in selected_fields for field in compulsory_fields):
         st.warning(f"Please select all compulsory fields: {compulsory_fields}")
     if all(field in selected_fields for field in compulsory_fields):
@@ -295,6 +2337,144 @@ with st.expander("$ \\large \\textrm {\\color{#F94C10} Inputs} $", expanded=True
     else:
         st.stop()
 
+# ----------------------------
+# Results rendering (shared by Run and background jobs)
+# ----------------------------
+def keep_results(combined_df) -> str:
+    """Keep results for panels that outlive this run (aggregation, SQL query box); returns the data hash."""
+    data_key = frame_fingerprint(combined_df)
+    st.session_state['combined_df'] = combined_df
+    st.session_state['combined_key'] = data_key
+    cache_in_background(combined_df, data_key)
+    return data_key
+
+def _coords_bytes(coords) -> bytes:
+    """Coordinate array as raw float64 bytes (JSON text for ragged multi-part geometries)."""
+    try:
+        return np.asarray(coords, dtype='float64').tobytes()
+    except ValueError:
+        return json.dumps(coords).encode()
+
+def geojson_fingerprint(geojson_data, fields=MAP_FIELDS) -> str:
+    """
+    Hash of what the map shows: the popup/tooltip properties of every feature and
+    the full coordinates of every geometry.
+    """
+    h = hashlib.md5()
+    for feature in geojson_data.get('features', []):
+        props = feature.get('properties') or {}
+        geom = feature.get('geometry') or {}
+        h.update(json.dumps([[props.get(f) for f in fields], geom.get('type')], default=str).encode())
+        h.update(_coords_bytes(geom.get('coordinates') or []))
+    return h.hexdigest()
+
+def map_html(geojson_data, df, start_time, end_time, flags=None) -> str:
+    """Rendered map document, cached by the features' content hash (rebuilt only when data changes)."""
+    def build():
+        m = create_map(geojson_data, df, start_time=start_time, end_time=end_time, flags=flags)
+        return folium.Figure().add_child(m).render()
+    flags_key = None if flags is None else frame_fingerprint(flags)
+    return cached_result((geojson_fingerprint(geojson_data), flags_key, "map_html"), build)
+
+def render_results(combined_geojson, combined_df, errors, start_time, end_time, profiler=None, data_key=None,
+                   anomaly_field=None):
+    """Failed requests, data table, map and WSE time series for one set of results."""
+    data_key = data_key or frame_fingerprint(combined_df)
+    lap = profiler.lap if profiler else (lambda name: None)
+    if errors:
+        with st.expander(":material/error: Some requests failed (click to expand)"):
+            for e in errors:
+                st.write(f"- {e}")
+
+    flags = None
+    if anomaly_field and {'reach_id', 'time_str', anomaly_field} <= set(combined_df.columns) and not combined_df.empty:
+        flags = detect_anomalies(combined_df, anomaly_field)
+        lap("detect")
+
+    # Show Data Table
+    st.write("### Data Table", combined_df if flags is None else combined_df.join(flags))
+    if flags is not None:
+        st.caption(
+            f"{int(flags['anomaly'].sum()):,} anomalous observation(s) and {int(flags['step'].sum()):,} "
+            f"step change(s) flagged in `{anomaly_field}` "
+            f"({flags.attrs['scored']:,} observation(s) scored, {flags.attrs['reused']:,} reused)."
+        )
+    lap("table")
+
+    # Map
+    st.text("")
+    st.markdown("""### Map""")
+    if combined_geojson.get('features'):
+        components.html(map_html(combined_geojson, combined_df, start_time, end_time, flags), height=510, width=screen_width)
+    else:
+        st.info("No valid geometries returned for the provided Reach ID(s).")
+    lap("map")
+
+    # ----------------------------------------------------------
+    # Time Series (WSE vs Date) — ALL reaches on ONE interactive plot
+    # ----------------------------------------------------------
+    st.text("")
+    st.markdown("### Time Series")
+
+    required_cols = {'reach_id', 'time_str', 'wse', 'river_name'}
+    if required_cols.issubset(set(combined_df.columns)) and not combined_df.empty:
+        ts = wse_series(combined_df)
+
+        if ts.empty:
+            st.info("No valid WSE time series points to plot after cleaning.")
+        else:
+            # Build (or reuse) the Plotly figure with dark background + neon lines
+            fig = wse_figure(ts, data_key, flags if flags is not None and flags.attrs['field'] == 'wse' else None)
+
+            # Render with optional click capture
+            if PLOTLY_EVENTS_AVAILABLE:
+                st.caption("Tip: Click a point to see details below.")
+                selected_points = plotly_events(
+                    fig,
+                    click_event=True,
+                    hover_event=False,
+                    select_event=False,
+                    override_height=420,
+                    override_width=screen_width if screen_width else None,
+                    key="wse_clicks"
+                )
+            else:
+                st.caption("Hover to inspect values.")
+                # Fallback: no click capture, just show chart
+                selected_points = None
+                st.plotly_chart(fig, use_container_width=True)
+
+            # If we captured a click, show details for that datapoint
+            if selected_points:
+                pt = selected_points[0]
+                curve, idx = pt.get("curveNumber"), pt.get("pointIndex", pt.get("pointNumber"))
+                if curve is not None and idx is not None and curve < len(fig.data):
+                    trace = fig.data[curve]
+                    # flag overlays carry their reach ids in customdata
+                    rid = trace.name if trace.customdata is None else str(trace.customdata[idx])
+                    river = ts.loc[ts['reach_id'] == rid, 'river_name'].iloc[0]
+                    t_utc = pd.to_datetime(int(trace.x[idx]), unit="ms", utc=True)
+                    st.success(
+                        f"**Selected Point**  \n"
+                        f"- Reach ID: `{rid}`  \n"
+                        f"- River: `{river}`  \n"
+                        f"- Time (UTC): `{t_utc.strftime('%Y-%m-%d %H:%M:%S')}`  \n"
+                        f"- WSE (m): `{trace.y[idx]:.3f}`"
+                    )
+
+            # Optional: download cleaned time series
+            csv_bytes = ts[['reach_id', 'river_name', 'time', 'wse']].rename(columns={'time': 'time_utc'}).to_csv(index=False).encode('utf-8')
+            st.download_button(
+                "Download cleaned WSE time series (CSV)",
+                data=csv_bytes,
+                file_name="wse_timeseries_clean_neon.csv",
+                mime="text/csv",
+                icon=":material/download:"
+            )
+    else:
+        st.info("Time series plotting requires 'reach_id', 'river_name', 'time_str', and 'wse' in the selected fields.")
+    lap("figure")
+
 # ----------------------------
 # Run
 # ----------------------------
@@ -303,146 +2483,412 @@ if st.button("Run", icon=":material/play_circle:"):
     if not reach_ids:
         st.warning("Please provide at least one Reach ID.")
     elif start_time and end_time and selected_fields:
-        with st.spinner(" Fetching data"):
-            combined_geojson, combined_df, errors = fetch_data_multi(
-                reach_ids, start_time, end_time, ','.join(selected_fields)
+        profiler = RunProfiler() if profile_run else None
+        with st.spinner(" Fetching data"), (profiler or contextlib.nullcontext()):
+            cached_features, cached_df, remote_reach_ids = serve_from_watchlist(
+                reach_ids, start_time, end_time, selected_fields, quality_rules
             )
+            combined_geojson, combined_df, errors = fetch_data_multi(
+                remote_reach_ids, start_time, end_time, ','.join(selected_fields), quality_rules,
+                network_mode=network_mode,
+                thread_name_prefix=f"{profiler.thread_prefix}-fetch" if profiler else "hydrocron-fetch"
+            ) if remote_reach_ids else ({"type": "FeatureCollection", "features": []}, cached_df.iloc[:0], [])
+            if cached_features:
+                st.caption(f"{len(reach_ids) - len(remote_reach_ids)} watchlist reach(es) served from the local cache.")
+                combined_geojson["features"] = cached_features + combined_geojson["features"]
+                dropped = combined_df.attrs.get('quality_dropped', 0) + cached_df.attrs.get('quality_dropped', 0)
+                dropped_by = Counter(combined_df.attrs.get('quality_dropped_by', {}))
+                dropped_by.update(cached_df.attrs.get('quality_dropped_by', {}))
+                combined_df = pd.concat([cached_df, combined_df.drop(columns=['ID'], errors='ignore')], ignore_index=True)
+                combined_df['ID'] = range(1, len(combined_df) + 1)
+                combined_df.attrs.update(quality_dropped=dropped, quality_dropped_by=dict(dropped_by))
+            if combined_df.attrs.get('quality_dropped'):
+                st.caption(quality_summary(combined_df.attrs['quality_dropped'], combined_df.attrs['quality_dropped_by']))
+
+            if profiler:
+                profiler.lap("fetch")
+            data_key = keep_results(combined_df)
+            render_results(combined_geojson, combined_df, errors, start_time, end_time, profiler, data_key,
+                           anomaly_field)
+
+            # ----------------------------------------------------------
+            # Node mode: along-reach WSE profiles per overpass
+            # ----------------------------------------------------------
+            if node_mode:
+                st.text("")
+                st.markdown("### Along-Reach WSE Profiles")
+                node_series, node_errors = fetch_node_series(
+                    reach_ids, start_time, end_time, network_mode=network_mode,
+                    max_node_q=1 if quality_rules else None,
+                    thread_name_prefix=f"{profiler.thread_prefix}-nodes" if profiler else "hydrocron-nodes"
+                )
+                st.session_state['node_series'] = node_series
+                if node_errors:
+                    with st.expander(f":material/error: {len(node_errors)} node request(s) failed (click to expand)"):
+                        for e in node_errors:
+                            st.write(f"- {e}")
+                if not node_series:
+                    st.info("No node observations returned for the provided Reach ID(s).")
+                else:
+                    st.caption(
+                        f"{sum(len(s.node_ids) for s in node_series.values()):,} nodes, "
+                        f"{sum(s.nbytes for s in node_series.values()) / 1e6:.2f} MB in memory."
+                    )
+                    st.plotly_chart(node_profile_figure(node_series), use_container_width=True)
+                    node_csv = pd.concat([s.to_frame() for s in node_series.values()], ignore_index=True)
+                    st.download_button(
+                        "Download node time series (CSV)",
+                        data=node_csv.to_csv(index=False).encode('utf-8'),
+                        file_name="node_timeseries.csv",
+                        mime="text/csv",
+                        icon=":material/download:"
+                    )
+                if profiler:
+                    profiler.lap("nodes")
 
-            if errors:
-                with st.expander(":material/error: Some requests failed (click to expand)"):
-                    for e in errors:
-                        st.write(f"- {e}")
+        if profiler:
+            render_profile(profiler)
 
-            # Show Data Table
-            st.write("### Data Table", combined_df)
+    else:
+        st.warning("Please enter all fields (Reach ID(s), Start Time, and End Time) to fetch data.")
 
-            # Map
-            st.text("")
-            st.markdown("""### Map""")
-            if combined_geojson.get('features'):
-                m = create_map(combined_geojson, combined_df, start_time=start_time, end_time=end_time)
-                folium_static(m, width=screen_width)
+# ----------------------------
+# Background jobs
+# ----------------------------
+@st.fragment(run_every=3)
+def job_status_panel(job_id: str):
+    """Live progress / ETA of one job; refreshes itself without rerunning the page."""
+    meta = job_manager().get(job_id)
+    if meta is None:
+        st.warning(f"Unknown job ID `{job_id}`.")
+        return
+    st.write(f"Job `{job_id}` — **{meta['status']}** — {meta['done']}/{meta['total']} reach(es)")
+    st.progress(meta["done"] / max(meta["total"], 1))
+    eta = job_eta(meta)
+    if eta is not None:
+        st.caption(f"About {eta:,.0f} s remaining.")
+    if meta["status"] == "failed":
+        st.error(f"Job failed: {meta['error']}")
+    elif meta["status"] == "interrupted":
+        st.warning("The app restarted while this job was running; please resubmit it.")
+
+with st.expander("$ \\large \\textrm {\\color{#F94C10} Background Jobs} $", expanded="job" in st.query_params, icon=":material/schedule:"):
+    st.caption(
+        "Large downloads can run in the background: submit, close the tab, and collect the "
+        "result later with the job ID (it is also kept in this page's URL)."
+    )
+    if st.button("Submit inputs as background job", icon=":material/send:"):
+        job_reach_ids = parse_reach_ids(reach_ids_text)
+        if not job_reach_ids:
+            st.warning("Please provide at least one Reach ID.")
+        else:
+            try:
+                new_job_id = job_manager().submit(
+                    job_reach_ids, start_time, end_time, ','.join(selected_fields),
+                    quality_rules, network_mode
+                )
+            except RuntimeError as e:
+                st.error(str(e))
             else:
-                st.info("No valid geometries returned for the provided Reach ID(s).")
+                st.query_params["job"] = new_job_id
+                st.session_state.setdefault("submitted_jobs", []).append(new_job_id)
+                st.success(f"Submitted job `{new_job_id}` for {len(job_reach_ids)} reach(es).")
 
-            # ----------------------------------------------------------
-            # Time Series (WSE vs Date) — ALL reaches on ONE interactive plot
-            # ----------------------------------------------------------
-            st.text("")
-            st.markdown("### Time Series")
+    job_id = st.text_input(":violet[**Job ID**]", st.query_params.get("job", "")).strip()
+    if job_id:
+        job_status_panel(job_id)
+        jcol1, jcol2 = st.columns(2)
+        with jcol1:
+            if st.button("Cancel job", icon=":material/cancel:"):
+                job_manager().cancel(job_id)
+                st.info("Cancellation requested.")
+        with jcol2:
+            load_job = st.button("Load result", icon=":material/download_done:")
 
-            required_cols = {'reach_id', 'time_str', 'wse', 'river_name'}
-            if required_cols.issubset(set(combined_df.columns)) and not combined_df.empty:
-                # Clean & prepare
-                ts = combined_df[['reach_id', 'river_name', 'time_str', 'wse']].copy()
-                ts['reach_id'] = ts['reach_id'].astype(str)
+    # Only this session's submissions and the job in the URL; job IDs are not discoverable
+    recent_jobs = job_manager().list_jobs(
+        st.session_state.get("submitted_jobs", []) + [st.query_params.get("job", "")]
+    )
+    if recent_jobs:
+        st.dataframe(pd.DataFrame([{
+            "job": m["id"],
+            "status": m["status"],
+            "progress": f"{m['done']}/{m['total']}",
+            "rows": m["rows"],
+            "submitted (UTC)": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(m["submitted_at"])),
+        } for m in recent_jobs]), hide_index=True, use_container_width=True)
+
+if job_id and load_job:
+    try:
+        job_geojson, job_df, job_errors = job_manager().load_result(job_id)
+    except Exception as e:
+        st.error(str(e))
+    else:
+        job_meta = job_manager().get(job_id)
+        job_key = keep_results(job_df)
+        render_results(job_geojson, job_df, job_errors, job_meta["start_time"], job_meta["end_time"],
+                       data_key=job_key, anomaly_field=anomaly_field)
 
-                # numeric WSE, drop sentinel + non-finite
-                ts['wse'] = pd.to_numeric(ts['wse'], errors='coerce').replace(-999999999999.0, np.nan)
-                ts = ts.replace([np.inf, -np.inf], np.nan).dropna(subset=['wse'])
+# ----------------------------
+# Watchlist
+# ----------------------------
+with st.expander("$ \\large \\textrm {\\color{#F94C10} Watchlist} $", expanded=False, icon=":material/visibility:"):
+    st.caption(
+        "Reaches on the watchlist can be refreshed in the background on a schedule, fetching only "
+        "observations newer than what is already cached. Runs over them are served from the cache."
+    )
+    watchlist = load_watchlist()
+    # The refresh thread only starts from a running app, and on a schedule only when opted in
+    scheduler = watchlist_scheduler() if watchlist["auto_refresh"] and st.runtime.exists() else None
+    wl_text = st.text_area(":violet[**Watchlist Reach ID(s)**]", " ".join(watchlist["reach_ids"]), height=100)
+    wcol1, wcol2 = st.columns(2)
+    with wcol1:
+        wl_interval = st.number_input("Refresh every (hours)", min_value=0.25, value=float(watchlist["interval_hours"]), step=1.0)
+    with wcol2:
+        wl_start = st.text_input("Keep history from", watchlist["history_start"], help="YYYY-MM-DDTHH:MM:SSZ")
+    wl_auto = st.checkbox("Refresh automatically on this schedule", value=watchlist["auto_refresh"])
+    bcol1, bcol2 = st.columns(2)
+    with bcol1:
+        if st.button("Save watchlist", icon=":material/save:"):
+            watchlist.update(reach_ids=parse_reach_ids(wl_text), interval_hours=wl_interval,
+                             history_start=wl_start, auto_refresh=wl_auto)
+            if wl_start != load_watchlist()["history_start"]:
+                watchlist["state"] = {}
+            save_watchlist(watchlist)
+            if wl_auto:
+                scheduler = watchlist_scheduler()
+                scheduler.trigger()
+                st.success(f"Saved {len(watchlist['reach_ids'])} reach(es); refreshing in the background.")
+            else:
+                st.success(f"Saved {len(watchlist['reach_ids'])} reach(es). Use Refresh now to fill the cache.")
+    with bcol2:
+        if st.button("Refresh now", icon=":material/refresh:"):
+            scheduler = watchlist_scheduler()
+            scheduler.trigger()
+            st.info("Refresh started in the background.")
+
+    if scheduler and scheduler.running:
+        st.caption("A refresh is running…")
+    last_errors = (scheduler.last_errors if scheduler else None) or watchlist.get("last_errors", [])
+    if last_errors:
+        with st.expander(f":material/error: {len(last_errors)} reach(es) failed in the last refresh"):
+            for e in last_errors:
+                st.write(f"- {e}")
+    if watchlist["state"]:
+        st.dataframe(pd.DataFrame([{
+            "reach_id": rid,
+            "latest cached": state.get("watermark"),
+            "new rows (last refresh)": state.get("new_rows"),
+            "refreshed (UTC)": time.strftime("%Y-%m-%d %H:%M", time.gmtime(state["refreshed_at"]))
+            if state.get("refreshed_at") else None,
+        } for rid, state in watchlist["state"].items()]), hide_index=True, use_container_width=True)
+
+# ----------------------------
+# Bulk export (per-reach archive)
+# ----------------------------
+with st.expander("$ \\large \\textrm {\\color{#F94C10} Bulk Export} $", expanded=False, icon=":material/folder_zip:"):
+    st.caption(
+        "One compressed CSV per reach plus a manifest (row counts, time ranges, SHA-256 checksums) "
+        "in a single zip. Fresh fetches are written reach by reach as they finish, so memory stays bounded."
+    )
+    export_source = st.radio(
+        "Source", ["Fetch the Reach ID(s) above", "Results of the last run"], horizontal=True,
+        disabled=st.session_state.get('combined_df') is None, index=0
+    )
+    if st.button("Build archive", icon=":material/folder_zip:"):
+        export_path = new_export_path()
+        export_bar = st.progress(0.0, text="Writing archive…")
 
-                # tz-aware UTC timestamps
-                ts['time'] = pd.to_datetime(ts['time_str'], errors='coerce', utc=True)
-                ts = ts.dropna(subset=['time']).sort_values(['reach_id', 'time'])
+        def export_progress(done, total):
+            export_bar.progress(done / max(total, 1), text=f"Writing archive… {done}/{total} reach(es)")
 
-                if ts.empty:
-                    st.info("No valid WSE time series points to plot after cleaning.")
+        try:
+            with open(export_path, "wb") as fh:
+                if export_source == "Results of the last run":
+                    manifest = export_reach_archive(
+                        fh, df=st.session_state['combined_df'], progress=export_progress
+                    )
                 else:
-                    # Build a Plotly figure with dark background + neon lines
-                    fig = go.Figure()
-                    for rid, sub in ts.groupby('reach_id', sort=False):
-                        color = nice_color_for_reach(rid)
-
-                        # Convert time → POSIX milliseconds (tz-aware safe)
-                        # Convert tz-aware datetime → tz-naive → POSIX milliseconds (int)
-                        epoch_ms = (
-                            sub['time']
-                            .dt.tz_convert('UTC')         # ensure consistent timezone
-                            .dt.tz_localize(None)         # remove timezone safely (not using astype)
-                            .astype('int64') // 1_000_000 # convert ns → ms
-                        )
-                        epoch_ms = epoch_ms.to_numpy(dtype='int64')  # ensure clean 1D array
-
-
-                        customdata = np.stack([
-                            sub['reach_id'].astype(str).values,
-                            sub['river_name'].astype(str).values,
-                            epoch_ms,
-                            sub['wse'].values
-                        ], axis=-1)
-
-                        fig.add_trace(go.Scatter(
-                            x=sub['time'],
-                            y=sub['wse'],
-                            mode='lines+markers',
-                            name=f"{rid}",
-                            line=dict(width=2, color=color),
-                            marker=dict(size=6, line=dict(width=0), color=color),
-                            hovertemplate="<b>Reach:</b> %{customdata[0]}<br>"
-                                        "<b>River:</b> %{customdata[1]}<br>"
-                                        "<b>Time (UTC):</b> %{x|%Y-%m-%d %H:%M:%S}<br>"
-                                        "<b>WSE (m):</b> %{y:.3f}<extra></extra>",
-                            customdata=customdata
-                        ))
-
-
-                    fig.update_layout(
-                        template="plotly_dark",
-                        height=420,
-                        margin=dict(l=40, r=20, t=50, b=40),
-                        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0),
-                        xaxis=dict(title="Date (UTC)", showgrid=True, gridwidth=0.3),
-                        yaxis=dict(title="Water Surface Elevation (m)", showgrid=True, gridwidth=0.3),
-                        # paper_bgcolor="#11151a",
-                        # plot_bgcolor="#11151a",
+                    manifest = export_reach_archive(
+                        fh, parse_reach_ids(reach_ids_text), start_time, end_time, ','.join(selected_fields),
+                        quality_rules, network_mode, progress=export_progress
                     )
+        except Exception as e:
+            st.error(f"Export failed: {e}")
+        else:
+            st.session_state['export_path'] = export_path
+            st.success(f"Archive ready: {manifest['reaches']} reach(es), {manifest['rows']:,} rows.")
+            if manifest.get("errors"):
+                st.warning(f"{len(manifest['errors'])} reach(es) failed:\n\n" + "\n".join(f"- {e}" for e in manifest["errors"]))
 
-                    # Render with optional click capture
-                    if PLOTLY_EVENTS_AVAILABLE:
-                        st.caption("Tip: Click a point to see details below.")
-                        selected_points = plotly_events(
-                            fig,
-                            click_event=True,
-                            hover_event=False,
-                            select_event=False,
-                            override_height=420,
-                            override_width=screen_width if screen_width else None,
-                            key="wse_clicks"
-                        )
-                    else:
-                        st.caption("Hover to inspect values.")
-                        # Fallback: no click capture, just show chart
-                        selected_points = None
-                        st.plotly_chart(fig, use_container_width=True)
-
-                    # If we captured a click, show details for that datapoint
-                    if selected_points:
-                        pt = selected_points[0]
-                        # pt contains point data with customdata indices
-                        cd = pt.get("customdata", [])
-                        if cd and len(cd) >= 4:
-                            rid, river, epoch_ms, wse_val = cd
-                            # epoch_ms is numpy int; convert to pandas/py datetime
-                            t_utc = pd.to_datetime(int(epoch_ms), unit="ms", utc=True)
-                            st.success(
-                                f"**Selected Point**  \n"
-                                f"- Reach ID: `{rid}`  \n"
-                                f"- River: `{river}`  \n"
-                                f"- Time (UTC): `{t_utc.strftime('%Y-%m-%d %H:%M:%S')}`  \n"
-                                f"- WSE (m): `{wse_val:.3f}`"
-                            )
-
-                    # Optional: download cleaned time series
-                    csv_bytes = ts[['reach_id', 'river_name', 'time', 'wse']].rename(columns={'time': 'time_utc'}).to_csv(index=False).encode('utf-8')
-                    st.download_button(
-                        "Download cleaned WSE time series (CSV)",
-                        data=csv_bytes,
-                        file_name="wse_timeseries_clean_neon.csv",
-                        mime="text/csv",
-                        icon=":material/download:"
-                    )
+    export_path = st.session_state.get('export_path')
+    if export_path and os.path.exists(export_path):
+        with open(export_path, "rb") as fh:
+            st.download_button(
+                "Download per-reach archive (ZIP)",
+                data=fh,
+                file_name=os.path.basename(export_path),
+                mime="application/zip",
+                icon=":material/download:"
+            )
+
+# ----------------------------
+# Aggregate the last run
+# ----------------------------
+with st.expander("$ \\large \\textrm {\\color{#F94C10} Aggregate} $", expanded=False, icon=":material/functions:"):
+    last_df = st.session_state.get('combined_df')
+    if last_df is None or last_df.empty:
+        st.info("Run a query first; per-reach statistics are computed from its results.")
+    else:
+        agg_fields_available = numeric_fields(last_df)
+        acol1, acol2, acol3 = st.columns(3)
+        with acol1:
+            agg_period = st.selectbox("Period", list(AGG_PERIODS))
+        with acol2:
+            agg_fields = st.multiselect(
+                "Fields", agg_fields_available,
+                default=[f for f in ['wse'] if f in agg_fields_available]
+            )
+        with acol3:
+            agg_stats = st.multiselect("Statistics", AGG_STATS, default=['mean', 'count'])
+
+        if agg_fields and agg_stats:
+            try:
+                agg_df = aggregate_observations(
+                    last_df, agg_fields, AGG_PERIODS[agg_period], agg_stats,
+                    data_key=st.session_state.get('combined_key')
+                )
+            except Exception as e:
+                st.error(f"Aggregation failed: {e}")
             else:
-                st.info("Time series plotting requires 'reach_id', 'river_name', 'time_str', and 'wse' in the selected fields.")
+                st.write(agg_df)
+                st.download_button(
+                    "Download aggregated statistics (CSV)",
+                    data=agg_df.to_csv(index=False).encode('utf-8'),
+                    file_name=f"hydrocron_{AGG_PERIODS[agg_period]}_stats.csv",
+                    mime="text/csv",
+                    icon=":material/download:"
+                )
 
+# ----------------------------
+# Cross-reach alignment of the last run
+# ----------------------------
+with st.expander("$ \\large \\textrm {\\color{#F94C10} Cross-Reach Comparison} $", expanded=False, icon=":material/stacked_line_chart:"):
+    last_df = st.session_state.get('combined_df')
+    if last_df is None or last_df.empty:
+        st.info("Run a query first; reaches are aligned from its results.")
     else:
-        st.warning("Please enter all fields (Reach ID(s), Start Time, and End Time) to fetch data.")
+        st.caption(
+            "Reaches are ordered upstream → downstream by `p_dist_out` (select it in the fields) "
+            "and aligned per overpass, giving longitudinal profiles, reach-to-reach gradients and lag correlations."
+        )
+        xcol1, xcol2, xcol3 = st.columns(3)
+        with xcol1:
+            align_fields = numeric_fields(last_df)
+            align_field = st.selectbox("Field", align_fields, index=align_fields.index('wse') if 'wse' in align_fields else 0)
+        with xcol2:
+            align_mode = st.selectbox(
+                "Align rows on", ["cycle_pass", "time"],
+                index=0 if {'cycle_id', 'pass_id'} <= set(last_df.columns) else 1,
+                format_func=lambda v: "cycle_id / pass_id" if v == "cycle_pass" else "overpass time window"
+            )
+        with xcol3:
+            align_tol = st.number_input("Time window (hours)", min_value=0.1, value=6.0, disabled=align_mode != "time")
+
+        try:
+            aligned = align_reaches(last_df, align_field, align_mode, align_tol,
+                                    data_key=st.session_state.get('combined_key'))
+        except Exception as e:
+            st.error(f"Alignment failed: {e}")
+        else:
+            row_labels = pd.to_datetime(aligned.times).strftime('%Y-%m-%d %H:%M')
+            st.write(f"{aligned.values.shape[0]} overpasses × {aligned.values.shape[1]} reaches")
+            heat = go.Figure(go.Heatmap(
+                z=aligned.values, x=aligned.reach_ids, y=row_labels, colorscale="Viridis",
+                colorbar=dict(title=align_field)
+            ))
+            heat.update_layout(template="plotly_dark", height=420, margin=dict(l=40, r=20, t=30, b=40),
+                               xaxis=dict(title="Reach (upstream → downstream)", type="category"),
+                               yaxis=dict(title="Overpass"))
+            st.plotly_chart(heat, use_container_width=True)
+
+            if not np.isnan(aligned.dist_out).all():
+                # every overpass as one NaN-separated segment of a single trace
+                n_rows, n_cols = aligned.values.shape
+                gap = np.full((n_rows, 1), np.nan)
+                profile = go.Figure(go.Scatter(
+                    x=np.hstack([np.tile(aligned.dist_out / 1000.0, (n_rows, 1)), gap]).ravel(),
+                    y=np.hstack([aligned.values, gap]).ravel(),
+                    customdata=np.repeat(row_labels.to_numpy(), n_cols + 1),
+                    mode='lines+markers', connectgaps=False, line=dict(width=1), marker=dict(size=4),
+                    hovertemplate="<b>Overpass:</b> %{customdata}<br><b>Dist. (km):</b> %{x:.1f}<br>"
+                                  "<b>Value:</b> %{y:.3f}<extra></extra>"
+                ))
+                profile.update_layout(template="plotly_dark", height=380, margin=dict(l=40, r=20, t=30, b=40),
+                                      xaxis=dict(title="Distance from outlet (km)", autorange="reversed"),
+                                      yaxis=dict(title=f"{align_field} (longitudinal profile)"))
+                st.plotly_chart(profile, use_container_width=True)
+
+                gradients = pd.DataFrame(
+                    reach_gradients(aligned),
+                    index=row_labels,
+                    columns=[f"{a}→{b}" for a, b in zip(aligned.reach_ids[:-1], aligned.reach_ids[1:])]
+                )
+                st.write("**Reach-to-reach gradient (cm/km)**", gradients)
+
+            if len(aligned.reach_ids) > 1:
+                st.write("**Lag correlation with the downstream neighbour**", neighbour_lag_table(aligned))
+
+            st.download_button(
+                "Download aligned matrix (CSV)",
+                data=pd.DataFrame(aligned.values, index=row_labels, columns=aligned.reach_ids).to_csv().encode('utf-8'),
+                file_name=f"aligned_{align_field}.csv",
+                mime="text/csv",
+                icon=":material/download:"
+            )
+
+# ----------------------------
+# Query cached observations (SQL)
+# ----------------------------
+with st.expander("$ \\large \\textrm {\\color{#F94C10} Query} $", expanded=False, icon=":material/database:"):
+    st.caption("Every Run is cached locally. Query it with a read-only SQL SELECT against the `obs` table — no network round trips.")
+    if not DUCKDB_AVAILABLE:
+        st.info("Install `duckdb` to enable the SQL query engine.")
+    else:
+        sql_text = st.text_area(
+            ":violet[**SQL**]",
+            "SELECT reach_id, count(*) AS n, min(time_str) AS first, max(time_str) AS last, avg(wse) AS mean_wse\n"
+            "FROM obs\nGROUP BY reach_id\nORDER BY reach_id",
+            height=130
+        )
+        qcol1, qcol2, qcol3 = st.columns(3)
+        with qcol1:
+            restrict_reaches = st.checkbox("Only the Reach ID(s) above", value=True)
+        with qcol2:
+            restrict_time = st.checkbox("Only between Start and End Time", value=False)
+        with qcol3:
+            max_reach_q = st.selectbox(
+                "Max reach_q", [None, 0, 1, 2, 3],
+                format_func=lambda v: "Any" if v is None else str(v)
+            )
+
+        if st.button("Run Query", icon=":material/manage_search:"):
+            try:
+                result_df = query_observations(
+                    sql_text,
+                    reach_ids=parse_reach_ids(reach_ids_text) if restrict_reaches else None,
+                    start_time=start_time if restrict_time else None,
+                    end_time=end_time if restrict_time else None,
+                    quality={"reach_q": max_reach_q} if max_reach_q is not None else None,
+                )
+            except Exception as e:
+                st.error(f"Query failed: {e}")
+            else:
+                st.write(f"{len(result_df):,} rows", result_df)
+                st.download_button(
+                    "Download query result (CSV)",
+                    data=result_df.to_csv(index=False).encode('utf-8'),
+                    file_name="hydrocron_query.csv",
+                    mime="text/csv",
+                    icon=":material/download:"
+                )
@@ -0,0 +1,9 @@
+import logging
+import os
+import sys
+import tempfile
+
+# Import the app module from the repository root with a throwaway cache dir.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("HYDROCRON_CACHE_DIR", tempfile.mkdtemp(prefix="hydrocron_test_cache_"))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
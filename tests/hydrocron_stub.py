@@ -0,0 +1,101 @@
+"""
+Local stand-in for the Hydrocron API, used by the tests and tests/perf_guard.py.
+
+serve_stub_hydrocron() starts an HTTP server on a free port that answers
+timeseries requests with deterministic synthetic data; with `capacity` it
+throttles (HTTP 429) like a saturated backend.
+"""
+import hashlib
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from hydrocron_st import QUALITY_RULES, STATIC_FIELDS, TEXT_FIELDS
+
+def synthetic_hydrocron_response(params: dict, n_obs: int = 30) -> dict:
+    """A Hydrocron-shaped geojson response with deterministic synthetic values (all strings, like the API)."""
+    rid = str(params.get("feature_id", "0"))
+    fields = params.get("fields", "reach_id,time_str,wse").split(',')
+    rng = np.random.default_rng(int(hashlib.md5(rid.encode()).hexdigest()[:8], 16))
+    lon0, lat0 = rng.uniform(140, 150), rng.uniform(-35, -25)
+    line = [[lon0 + k * 1e-3, lat0 + k * 7e-4] for k in range(40)]
+    t0 = pd.Timestamp("2023-01-01T00:00:00Z")
+    features = []
+    for i in range(n_obs):
+        t = t0 + pd.Timedelta(days=21 * i, seconds=int(rng.integers(0, 600)))
+        props = {}
+        for f in fields:
+            if f in ('reach_id', 'node_id'):
+                props[f] = rid
+            elif f == 'p_n_nodes':
+                props[f] = "12"
+            elif f == 'p_dist_out':
+                props[f] = str(100000.0 - 200.0 * int(rid[-4:-1]) if params.get("feature") == "Node" else 100000.0)
+            elif f in ('time_str', 'range_start_time', 'range_end_time', 'ingest_time'):
+                props[f] = t.strftime("%Y-%m-%dT%H:%M:%SZ")
+            elif f == 'river_name':
+                props[f] = "Synthetic River"
+            elif f == 'continent_id':
+                props[f] = "OC"
+            elif f in TEXT_FIELDS:
+                props[f] = "synthetic"
+            elif f in STATIC_FIELDS:
+                props[f] = str(int(hashlib.md5(f"{rid}{f}".encode()).hexdigest()[:6], 16) % 10000 / 10)
+            elif f in QUALITY_RULES or f == 'node_q':
+                props[f] = "0"
+            elif f in ('cycle_id', 'pass_id'):
+                props[f] = str(470 + i if f == 'cycle_id' else 12)
+            else:
+                props[f] = str(round(float(rng.normal(100, 2)), 4))
+        features.append({"type": "Feature", "id": str(i), "properties": props,
+                         "geometry": {"type": "LineString", "coordinates": line}})
+    return {"status": "200 OK", "time": 1.0, "hits": n_obs,
+            "results": {"csv": "", "geojson": {"type": "FeatureCollection", "features": features}}}
+
+def serve_stub_hydrocron(capacity: int | None = None, latency: float = 0.05, n_obs: int = 30):
+    """
+    Start a local Hydrocron stand-in on a free port (daemon thread); returns (server, url).
+    With `capacity`, requests beyond that many in flight get HTTP 429, and latency
+    grows with load the way a saturated backend does.
+    """
+    state = {"in_flight": 0, "requests": 0, "throttled": 0, "lock": threading.Lock()}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+            with state["lock"]:
+                state["requests"] += 1
+                state["in_flight"] += 1
+                load = state["in_flight"]
+            try:
+                if capacity is not None and load > capacity:
+                    with state["lock"]:
+                        state["throttled"] += 1
+                    self.send_response(429)
+                    self.send_header("Retry-After", "0.05")
+                    self.end_headers()
+                    return
+                time.sleep(latency * (1 + 0.1 * load))
+                body = json.dumps(synthetic_hydrocron_response(params, n_obs)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            finally:
+                with state["lock"]:
+                    state["in_flight"] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.stats = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/hydrocron/v1/timeseries"
@@ -0,0 +1,251 @@
+"""
+Memory and throughput regression guard for the Run pipeline.
+
+Replays fixed synthetic workloads (parse_reach_ids, fetch_data_multi against a
+local Hydrocron stub, get_geojson_bounds, create_map and the WSE time-series
+build), records peak RSS growth, peak traced allocations and wall time, and
+compares them with tests/perf_baseline.json:
+
+    python tests/perf_guard.py                      # exit 1 on regression
+    python tests/perf_guard.py --update-baseline    # record a new baseline
+
+The committed baseline was recorded on a single-CPU Linux container. Wall times
+depend on the machine, so CI should record its own baseline once per runner
+image (run with --update-baseline and keep the file as a build artifact or commit
+it), then run the guard on every change. Memory figures carry over between
+machines far better than wall times.
+"""
+import os
+import sys
+import time
+import json
+import uuid
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("HYDROCRON_CACHE_DIR", tempfile.mkdtemp(prefix="hydrocron_perf_cache_"))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+import folium
+import numpy as np
+import pandas as pd
+
+import hydrocron_st as app
+from hydrocron_stub import serve_stub_hydrocron
+
+PERF_BASELINE_PATH = os.environ.get(
+    "HYDROCRON_PERF_BASELINE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "perf_baseline.json")
+)
+PERF_THRESHOLD = float(os.environ.get("HYDROCRON_PERF_THRESHOLD", "0.25"))
+# Wall time is noisier than memory on shared machines, so it gets its own tolerance.
+PERF_TIME_THRESHOLD = float(os.environ.get("HYDROCRON_PERF_TIME_THRESHOLD", "0.5"))
+# Regressions smaller than these absolute amounts are treated as noise.
+PERF_METRICS = {"wall_s": 0.005, "peak_rss_mb": 1.0, "alloc_peak_mb": 0.25}
+
+def _rss_bytes() -> int:
+    """Resident set size of this process (Linux /proc; 0 where unavailable)."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+def measure_workload(fn, repeat: int = 5) -> dict:
+    """
+    Peak RSS growth of a cold first run (sampled every 2 ms), peak traced Python
+    allocations of a second run, and the best wall time of `repeat` more runs.
+    """
+    base = _rss_bytes()
+    peak = {"rss": base}
+    stop = threading.Event()
+
+    def sample():
+        while not stop.is_set():
+            peak["rss"] = max(peak["rss"], _rss_bytes())
+            stop.wait(0.002)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        fn()
+    finally:
+        stop.set()
+        sampler.join()
+    peak["rss"] = max(peak["rss"], _rss_bytes())
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, alloc_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    return {
+        "wall_s": min(timings),
+        "peak_rss_mb": (peak["rss"] - base) / 2**20,
+        "alloc_peak_mb": alloc_peak / 2**20,
+    }
+
+def _measure_child(fn, conn):
+    try:
+        conn.send(measure_workload(fn))
+    except Exception as e:
+        conn.send({"error": repr(e)})
+    finally:
+        conn.close()
+
+def measure_isolated(fn) -> dict:
+    """measure_workload in a forked child so each workload starts from the same heap."""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return measure_workload(fn)
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_measure_child, args=(fn, child_conn), daemon=True)
+    proc.start()
+    child_conn.close()
+    result = parent_conn.recv()
+    proc.join()
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+def perf_workloads(n_reaches: int = 60, n_obs: int = 30, n_ids: int = 20_000) -> tuple[dict, callable]:
+    """
+    Fixed synthetic workloads over the Run pipeline, served by a local stub.
+    Returns ({name: callable}, cleanup).
+    """
+    server, url = serve_stub_hydrocron(latency=0.005, n_obs=n_obs)
+    meta_dir = tempfile.mkdtemp(prefix="hydrocron_perf_")
+    saved = app.HYDROCRON_URL, app.REACH_META_DIR
+    app.HYDROCRON_URL, app.REACH_META_DIR = url, meta_dir
+
+    reach_ids = [f"{7100000000 + 10 * i:010d}1" for i in range(n_reaches)]
+    separators = [",", " ", "\n", ", ", ";"]
+    ids_text = "".join(
+        f"{7100000000 + i % (n_ids // 2):010d}1{separators[i % len(separators)]}" for i in range(n_ids)
+    )
+    fields = "reach_id,time_str,wse,width,river_name,continent_id"
+    start, end = "2023-01-01T00:00:00Z", "2025-01-01T00:00:00Z"
+
+    def fetch():
+        # cold metadata sidecar, so every run sends the same requests
+        app._reach_metadata_store()[0].clear()
+        shutil.rmtree(meta_dir, ignore_errors=True)
+        return app.fetch_data_multi(reach_ids, start, end, fields, network_mode="live",
+                                limiter=(app.TokenBucket(10_000), app.AIMDController(initial=8)))
+
+    geojson_data, df, errors = fetch()
+    if errors:
+        raise RuntimeError(f"perf workload fetch failed: {errors[:3]}")
+    app._reach_metadata_store()[0].clear()
+
+    def render_map():
+        m = app.create_map(geojson_data, df, start, end)
+        return folium.Figure().add_child(m).render()
+
+    def time_series():
+        fig = app.wse_figure(app.wse_series(df), uuid.uuid4().hex)
+        return fig.to_json()
+
+    def cleanup():
+        app.HYDROCRON_URL, app.REACH_META_DIR = saved
+        server.shutdown()
+        shutil.rmtree(meta_dir, ignore_errors=True)
+
+    workloads = {
+        "parse_reach_ids": lambda: app.parse_reach_ids(ids_text),
+        "fetch_data_multi": fetch,
+        "get_geojson_bounds": lambda: app.get_geojson_bounds(geojson_data),
+        "create_map": render_map,
+        "time_series": time_series,
+    }
+    return workloads, cleanup
+
+def compare_to_baseline(current: dict, baseline: dict, threshold: float = PERF_THRESHOLD,
+                        time_threshold: float = PERF_TIME_THRESHOLD) -> pd.DataFrame:
+    """
+    One row per workload and metric; status REGRESSED when the relative increase exceeds
+    the threshold (time_threshold for wall time) and the absolute one the noise floor.
+    """
+    rows = []
+    for name, metrics in current.items():
+        for metric, floor in PERF_METRICS.items():
+            limit = time_threshold if metric == "wall_s" else threshold
+            value = metrics[metric]
+            base = baseline.get(name, {}).get(metric)
+            if base is None:
+                status, change = "new", np.nan
+            else:
+                change = (value - base) / base if base else np.nan
+                if value > base * (1 + limit) and value - base > floor:
+                    status = "REGRESSED"
+                elif value < base * (1 - limit) and base - value > floor:
+                    status = "improved"
+                else:
+                    status = "ok"
+            rows.append({"workload": name, "metric": metric, "baseline": base, "current": value,
+                         "change": change, "status": status})
+    return pd.DataFrame(rows)
+
+def perf_guard(baseline_path: str = PERF_BASELINE_PATH, threshold: float = PERF_THRESHOLD,
+               time_threshold: float = PERF_TIME_THRESHOLD, update: bool = False) -> bool:
+    """
+    Run the workloads, print a comparison with the baseline file and return False on
+    any regression or when there is no baseline to compare with. update=True
+    records the results as the new baseline instead.
+    """
+    if not update and not os.path.exists(baseline_path):
+        print(f"No baseline at {baseline_path}; record one with --update-baseline.")
+        return False
+    workloads, cleanup = perf_workloads()
+    try:
+        for fn in workloads.values():
+            fn()            # lazy imports and one-off setup stay out of the measurements
+        current = {name: measure_isolated(fn) for name, fn in workloads.items()}
+    finally:
+        cleanup()
+
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as fh:
+            baseline = json.load(fh).get("workloads", {})
+    table = compare_to_baseline(current, baseline, threshold, time_threshold)
+    print(table.assign(
+        baseline=[("-" if pd.isna(v) else f"{v:.4f}") for v in table["baseline"]],
+        current=[f"{v:.4f}" for v in table["current"]],
+        change=[("-" if pd.isna(v) else f"{v:+.1%}") for v in table["change"]],
+    ).to_string(index=False))
+
+    regressed = table[table["status"] == "REGRESSED"]
+    if update:
+        with open(baseline_path, "w") as fh:
+            json.dump({"recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                       "python": sys.version.split()[0], "workloads": current}, fh, indent=1)
+        print(f"Baseline written to {baseline_path}")
+        return True
+    print(f"{len(regressed)} regression(s) beyond {threshold:.0%} memory / {time_threshold:.0%} wall time "
+          f"-> {'FAIL' if len(regressed) else 'OK'}")
+    return regressed.empty
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory and throughput regression guard for the Run pipeline.")
+    parser.add_argument("--baseline", default=PERF_BASELINE_PATH, help="baseline JSON file")
+    parser.add_argument("--threshold", type=float, default=PERF_THRESHOLD,
+                        help="allowed relative memory regression (0.25 = 25%%)")
+    parser.add_argument("--time-threshold", type=float, default=PERF_TIME_THRESHOLD,
+                        help="allowed relative wall-time regression")
+    parser.add_argument("--update-baseline", action="store_true", help="record this run as the baseline")
+    args = parser.parse_args()
+    sys.exit(0 if perf_guard(args.baseline, args.threshold, args.time_threshold, args.update_baseline) else 1)
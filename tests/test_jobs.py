@@ -0,0 +1,47 @@
+import json
+import os
+import time
+
+import pytest
+
+import hydrocron_st as app
+
+
+@pytest.fixture
+def jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "JOBS_DIR", str(tmp_path))
+    return tmp_path
+
+
+def write_job(jobs_dir, job_id, status="done", age_days=0.0):
+    job_dir = jobs_dir / job_id
+    job_dir.mkdir()
+    meta_path = job_dir / "meta.json"
+    meta_path.write_text(json.dumps({
+        "id": job_id, "status": status, "submitted_at": time.time() - age_days * 86400,
+        "done": 1, "total": 1, "rows": 0, "errors": [],
+    }))
+    stamp = time.time() - age_days * 86400
+    os.utime(meta_path, (stamp, stamp))
+
+
+def test_prune_removes_expired_jobs_only(jobs_dir):
+    write_job(jobs_dir, "fresh", age_days=1)
+    write_job(jobs_dir, "stale", age_days=30)
+    manager = app.JobManager(workers=1)
+    try:
+        assert sorted(os.listdir(jobs_dir)) == ["fresh"]
+        assert manager.get("stale") is None
+    finally:
+        manager.pool.shutdown()
+
+
+def test_list_jobs_returns_only_requested_ids(jobs_dir):
+    for job_id in ("mine", "theirs"):
+        write_job(jobs_dir, job_id)
+    manager = app.JobManager(workers=1)
+    try:
+        listed = manager.list_jobs(["mine", "", "mine", "missing"])
+        assert [m["id"] for m in listed] == ["mine"]
+    finally:
+        manager.pool.shutdown()
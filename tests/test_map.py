@@ -0,0 +1,14 @@
+import hydrocron_st as app
+from hydrocron_stub import synthetic_hydrocron_response
+
+
+def test_map_embeds_one_color_per_feature_and_no_style_objects():
+    features = []
+    for i in range(5):
+        response = synthetic_hydrocron_response(
+            {"feature_id": f"{7000000000 + i:010d}1", "fields": "reach_id,time_str,wse,river_name,continent_id"}
+        )
+        features += response["results"]["geojson"]["features"]
+    html = app.create_map({"type": "FeatureCollection", "features": features}, None, "", "").get_root().render()
+    assert html.count('"color"') == len(features)
+    assert '"style"' not in html
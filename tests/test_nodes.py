@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+
+import hydrocron_st as app
+from hydrocron_stub import serve_stub_hydrocron
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    server, url = serve_stub_hydrocron(latency=0.02, n_obs=5)
+    monkeypatch.setattr(app, "HYDROCRON_URL", url)
+    monkeypatch.setattr(app, "REACH_META_DIR", str(tmp_path / "reach_meta"))
+    yield server
+    server.shutdown()
+
+
+def test_nodes_of_all_reaches_are_fetched_together(stub, monkeypatch):
+    """Node requests of different reaches overlap instead of running reach by reach."""
+    fetch_node_rows, lock = app.fetch_node_rows, threading.Lock()
+    in_flight, overlap = {}, []
+
+    def tracking_fetch(node_id, *args, **kwargs):
+        reach = node_id[:10]
+        with lock:
+            in_flight[reach] = in_flight.get(reach, 0) + 1
+            overlap.append(sum(1 for n in in_flight.values() if n))
+        try:
+            return fetch_node_rows(node_id, *args, **kwargs)
+        finally:
+            with lock:
+                in_flight[reach] -= 1
+
+    monkeypatch.setattr(app, "fetch_node_rows", tracking_fetch)
+    reach_ids = [f"{7420000000 + 10 * i}1" for i in range(6)]
+    series, errors = app.fetch_node_series(
+        reach_ids, "2023-01-01T00:00:00Z", "2024-01-01T00:00:00Z", network_mode="live",
+        limiter=(app.TokenBucket(1000), app.AIMDController(initial=16)), max_node_q=None,
+    )
+    assert not errors
+    assert sorted(series) == reach_ids
+    assert all(len(s.node_ids) == 12 for s in series.values())
+    assert max(overlap) > 1
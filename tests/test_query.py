@@ -0,0 +1,48 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+import hydrocron_st as app
+
+pytestmark = pytest.mark.skipif(not app.DUCKDB_AVAILABLE, reason="duckdb is not installed")
+
+
+@pytest.fixture
+def obs_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "OBS_DIR", str(tmp_path / "obs"))
+    app.cache_observations(pd.DataFrame({
+        "reach_id": ["74100600011"] * 3 + ["74100600021"] * 3,
+        "time_str": ["2023-01-01T00:00:00Z", "2023-02-01T00:00:00Z", "2023-03-01T00:00:00Z"] * 2,
+        "wse": ["10.0", "11.0", "12.0", "20.0", "21.0", "22.0"],
+    }))
+    return tmp_path / "obs"
+
+
+def test_query_filters_and_aggregates(obs_cache):
+    df = app.query_observations(
+        "SELECT reach_id, max(wse) AS top FROM obs WHERE wse > 10 GROUP BY reach_id ORDER BY reach_id",
+        start_time="2023-01-15T00:00:00Z",
+    )
+    assert df.to_dict("list") == {"reach_id": ["74100600011", "74100600021"], "top": [12.0, 22.0]}
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM read_csv('/etc/passwd')",
+    "SELECT 1; SELECT 2",
+    "COPY obs TO '/tmp/out.csv'",
+    "SET enable_external_access = true",
+])
+def test_query_is_sandboxed(obs_cache, sql):
+    with pytest.raises(Exception):
+        app.query_observations(sql)
+
+
+def test_prune_keeps_recent_and_listed_reaches(obs_cache):
+    stale = time.time() - 40 * 86400
+    for rid in ("74100600011", "74100600021"):
+        path = obs_cache / f"reach_id={rid}" / "data.parquet"
+        os.utime(path, (stale, stale))
+    assert app.prune_observation_cache(max_age_days=30, keep=["74100600021"]) == 1
+    assert sorted(os.listdir(obs_cache)) == ["reach_id=74100600021"]
@@ -0,0 +1,29 @@
+import pytest
+
+import hydrocron_st as app
+from hydrocron_stub import serve_stub_hydrocron
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    server, url = serve_stub_hydrocron(latency=0.0)
+    monkeypatch.setattr(app, "HYDROCRON_URL", url)
+    monkeypatch.setattr(app, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "REACH_META_DIR", str(tmp_path / "reach_meta"))
+    yield server
+    server.shutdown()
+
+
+def test_record_then_replay_round_trip(stub):
+    """A recorded run replays identically, even though recording warmed the reach metadata sidecar."""
+    reach_id, fields = "7310000011", "reach_id,time_str,wse,river_name,continent_id"
+    args = (reach_id, "2023-01-01T00:00:00Z", "2024-01-01T00:00:00Z", fields)
+
+    _, recorded, _, _ = app.fetch_data(*args, network_mode="record")
+    assert app.load_reach_metadata(reach_id)
+    requests_before_replay = stub.stats["requests"]
+    _, replayed, _, _ = app.fetch_data(*args, network_mode="replay")
+
+    assert len(recorded) == 30
+    assert stub.stats["requests"] == requests_before_replay
+    assert replayed.equals(recorded)
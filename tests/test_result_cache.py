@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import hydrocron_st as app
+
+
+@pytest.fixture
+def empty_store():
+    store = app._result_store()
+    with store["lock"]:
+        store["items"].clear()
+        store["bytes"] = 0
+    return store
+
+
+def test_cache_is_bounded_by_estimated_bytes(empty_store):
+    calls = []
+
+    def array(i):
+        def compute():
+            calls.append(i)
+            return np.zeros(1000)  # 8000 bytes
+        return compute
+
+    for i in (1, 2, 3):
+        app.cached_result(("bytes", i), array(i), max_bytes=20000)
+    assert empty_store["bytes"] <= 20000
+    assert [k[1] for k in empty_store["items"]] == [2, 3]
+
+    app.cached_result(("bytes", 3), array(3), max_bytes=20000)
+    app.cached_result(("bytes", 1), array(1), max_bytes=20000)
+    assert calls == [1, 2, 3, 1]
+
+
+def test_oversized_values_are_not_stored(empty_store):
+    frame = pd.DataFrame({"reach_id": ["74100600011"] * 1000, "wse": np.arange(1000.0)})
+    assert app.estimate_bytes(frame) > 8000
+    assert app.cached_result(("big",), lambda: frame, max_bytes=8000) is frame
+    assert not empty_store["items"] and empty_store["bytes"] == 0
@@ -0,0 +1,75 @@
+import socket
+import time
+
+import numpy as np
+import pytest
+import requests
+
+import hydrocron_st as app
+from hydrocron_stub import serve_stub_hydrocron
+
+
+@pytest.fixture
+def throttling_stub(monkeypatch):
+    """Stub that answers 429 above 6 concurrent requests, wired in as HYDROCRON_URL."""
+    server, url = serve_stub_hydrocron(capacity=6, latency=0.05)
+    monkeypatch.setattr(app, "HYDROCRON_URL", url)
+    yield server
+    server.shutdown()
+
+
+def test_aimd_settles_at_backend_capacity(throttling_stub):
+    """
+    Fetching 150 reaches from a backend that throttles above 6 concurrent requests:
+    the AIMD limit settles around the capacity, few requests are throttled, nothing
+    fails, and concurrency still beats fetching serially.
+    """
+    capacity, n_reaches, latency = 6, 150, 0.05
+    controller = app.AIMDController(initial=1, maximum=4 * capacity)
+    started = time.perf_counter()
+    _, df, errors = app.fetch_data_multi(
+        [f"{7000000000 + i:010d}1" for i in range(n_reaches)],
+        "2023-01-01T00:00:00Z", "2024-01-01T00:00:00Z", "reach_id,time_str,wse",
+        network_mode="live", limiter=(app.TokenBucket(1000), controller)
+    )
+    elapsed = time.perf_counter() - started
+
+    stats = throttling_stub.stats
+    limits = [limit for _, limit in controller.history]
+    settled = np.mean(limits[len(limits) // 2:])
+    assert not errors
+    assert len(df) == 30 * n_reaches
+    assert capacity / 2 <= settled <= capacity + 1
+    assert stats["throttled"] / stats["requests"] < 0.25
+    assert (n_reaches * latency) / elapsed > 1.5
+
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/hydrocron/v1/timeseries"
+
+
+def test_connection_errors_cut_the_limit(monkeypatch):
+    monkeypatch.setattr(app, "HYDROCRON_URL", closed_port_url())
+    monkeypatch.setattr(app, "MAX_ATTEMPTS", 1)
+    controller = app.AIMDController(initial=2)
+    for _ in range(10):
+        with pytest.raises(requests.ConnectionError):
+            app.limited_get({"feature_id": "1"}, "live", (app.TokenBucket(1000), controller))
+    assert controller.limit == controller.minimum
+    assert controller.in_flight == 0
+
+
+def test_other_failures_leave_the_limit_alone(monkeypatch):
+    def broken_get(params, mode=None):
+        raise ValueError("not JSON")
+
+    monkeypatch.setattr(app, "hydrocron_get", broken_get)
+    controller = app.AIMDController(initial=2)
+    for _ in range(10):
+        with pytest.raises(ValueError):
+            app.limited_get({"feature_id": "1"}, "live", (app.TokenBucket(1000), controller))
+    assert controller.limit == 2
+    assert controller.in_flight == 0
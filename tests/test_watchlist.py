@@ -0,0 +1,37 @@
+import threading
+import time
+
+import pytest
+
+import hydrocron_st as app
+
+
+@pytest.fixture
+def watchlist_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "WATCHLIST_PATH", str(tmp_path / "watchlist.json"))
+    monkeypatch.setattr(app, "GEOM_DIR", str(tmp_path / "geom"))
+    monkeypatch.setattr(app, "OBS_DIR", str(tmp_path / "obs"))
+    return tmp_path
+
+
+def test_import_does_not_start_the_scheduler():
+    assert "hydrocron-watchlist" not in [t.name for t in threading.enumerate()]
+
+
+@pytest.mark.skipif(not app.DUCKDB_AVAILABLE, reason="duckdb is not installed")
+def test_empty_cache_falls_back_to_remote_fetch(watchlist_dirs):
+    """A fresh watchlist reach with geometry but no cached observations is fetched remotely, not a crash."""
+    reach_id = "7310000011"
+    watchlist = app.load_watchlist()
+    watchlist.update(reach_ids=[reach_id], state={reach_id: {"refreshed_at": time.time(), "new_rows": 0}})
+    app.save_watchlist(watchlist)
+    app.save_reach_geometry({"features": [{
+        "properties": {"reach_id": reach_id},
+        "geometry": {"type": "LineString", "coordinates": [[140.0, -30.0], [140.1, -30.1]]},
+    }]})
+
+    features, df, remaining = app.serve_from_watchlist(
+        [reach_id], "2023-01-01T00:00:00Z", "2024-01-01T00:00:00Z", ["reach_id", "time_str", "wse"]
+    )
+    assert features == [] and df.empty
+    assert remaining == [reach_id]